@@ -0,0 +1,399 @@
+print("Loading imports...")
+
+import os
+import sys
+import json
+import time
+import wave
+import shutil
+import random
+import argparse
+import platform
+import resource
+import tempfile
+import statistics
+import subprocess
+import dataclasses
+from types import SimpleNamespace
+from datetime import datetime, timedelta
+
+import numpy as np
+
+# Throughput benchmark for transcribe.py. It builds a scratch tree with synthetic recordings and Logseq
+# pages, runs the one-shot pipeline against it in a child process and writes what it measured to JSON:
+# real-time factor, files per hour, per-stage time from the timings log, peak RSS and the filesystem
+# operations made under the scratch tree. With --backend stub the Whisper model is replaced by a
+# deterministic stub and VAD by an energy detector, so runs need no network, GPU or model download.
+#
+#   python benchmark.py --recordings 20 --seconds 120 --pages 2000 --output after.json --baseline before.json
+#
+# Every other setting of transcribe.py (TRANSCRIBE_WORKERS, MAX_AUDIO_MEMORY_MB, ...) is read from the
+# environment as usual and recorded with the results.
+
+sampling_rate = 16000
+fixture_start = datetime(2024, 1, 1, 8, 0, 0)
+transcribe_settings = (
+    "WHISPER_MODEL", "WHISPER_COMPUTE_TYPE", "DRAFT_MODEL", "TRANSCRIBE_WORKERS", "TRANSCRIBE_CPU_THREADS",
+    "TRANSCRIBE_BATCH_SIZE", "CHUNK_THRESHOLD_SECONDS", "CHUNK_SECONDS", "CHUNK_WORKERS",
+    "MAX_AUDIO_MEMORY_MB", "AUDIO_CACHE_MAX_GB", "MATERIALIZE_STRATEGIES", "LANGUAGE_DETECTION_WINDOWS",
+)
+
+# Stub model: one segment every segment_seconds of the audio it is given, after sleeping for the
+# time a model with the given real-time factor would take to produce it
+@dataclasses.dataclass
+class StubSegment:
+    start: float
+    end: float
+    text: str
+    avg_logprob: float = -0.2
+    no_speech_prob: float = 0.01
+
+class StubWhisperModel:
+    def __init__(self, real_time_factor, segment_seconds=4.0, multilingual=True):
+        self.real_time_factor = real_time_factor
+        self.segment_seconds = segment_seconds
+        # Stands in for the CTranslate2 model WhisperModel wraps
+        self.model = SimpleNamespace(is_multilingual=multilingual)
+
+    def detect_language(self, audio=None, **options):
+        if not self.model.is_multilingual:
+            raise RuntimeError("detect_language can only be called with multilingual models")
+        time.sleep(len(audio) / sampling_rate * self.real_time_factor / 10)
+        return "en", 0.99, [("en", 0.99), ("fi", 0.01)]
+
+    def transcribe(self, audio, **options):
+        duration = len(audio) / sampling_rate
+
+        def segments():
+            start = 0.0
+            index = 0
+            while start < duration:
+                end = min(start + self.segment_seconds, duration)
+                time.sleep((end - start) * self.real_time_factor)
+                yield StubSegment(start, end, f" Synthetic segment {index} of a benchmark recording.")
+                start = end
+                index += 1
+
+        info = SimpleNamespace(language=options.get("language") or "en", language_probability=0.99, duration=duration)
+        return segments(), info
+
+# Function to find the bursts in a synthetic recording, standing in for Silero VAD which does not take
+# synthetic tones for speech. Gets one VAD window of the recording at a time.
+def energy_vad(audio, frame=512, threshold=0.01, min_silence_frames=16):
+    speech = []
+    frames = len(audio) // frame
+    energy = np.sqrt(np.mean(np.asarray(audio[:frames * frame], dtype=np.float32).reshape(frames, frame) ** 2, axis=1))
+    for index in np.flatnonzero(energy > threshold):
+        start = int(index) * frame
+        if speech and start - speech[-1]["end"] <= min_silence_frames * frame:
+            speech[-1]["end"] = start + frame
+        else:
+            speech.append({"start": start, "end": start + frame})
+    return speech
+
+# Function to swap the model and VAD of transcribe.py for the stubs. Runs in the benchmark child and,
+# through the spawn start method importing this file as __mp_main__, in every transcription worker.
+def install_stub_backend():
+    import transcribe
+
+    real_time_factor = float(os.environ.get("BENCHMARK_STUB_RTF", "0.05"))
+    transcribe.load_model = lambda model_size, compute_type: StubWhisperModel(real_time_factor)
+    transcribe.speech_timestamps = energy_vad
+    return transcribe
+
+if os.environ.get("BENCHMARK_BACKEND") == "stub" and __name__ != "__main__":
+    install_stub_backend()
+
+# Function to write a synthetic recording: bursts of harmonic tone, amplitude modulated at a syllable
+# rate, separated by pauses of low noise. Written a second at a time so long fixtures need little memory.
+def write_recording(path, seconds, seed):
+    rng = random.Random(seed)
+    noise = np.random.default_rng(seed)
+    with wave.open(path, "wb") as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(sampling_rate)
+        written = 0
+        total = int(seconds * sampling_rate)
+        while written < total:
+            burst = int(rng.uniform(3, 8) * sampling_rate)
+            pause = int(rng.uniform(0.5, 2) * sampling_rate)
+            pitch = rng.uniform(100, 250)
+            for part, voiced in ((burst, True), (pause, False)):
+                part = min(part, total - written)
+                for offset in range(0, part, sampling_rate):
+                    count = min(sampling_rate, part - offset)
+                    t = (written + offset + np.arange(count)) / sampling_rate
+                    samples = noise.normal(0, 0.002, count)
+                    if voiced:
+                        envelope = 0.5 + 0.5 * np.sin(2 * np.pi * 4 * t)
+                        samples += 0.2 * envelope * sum(np.sin(2 * np.pi * pitch * h * t) / h for h in (1, 2, 3))
+                    f.writeframes((np.clip(samples, -1, 1) * 32767).astype("<i2").tobytes())
+                written += part
+
+# Function to write a Logseq page the way the pipeline does, for a recording in recordings_backup
+def write_page(path, audio_name, seconds, language=None):
+    lines = [
+        f"- ![{audio_name}](../assets/{audio_name})\n",
+        "- _metadata_\n",
+        "  collapsed:: true\n",
+        "    - Detected language: en\n",
+        "    - Language probability: 0.99\n",
+        "    - Model: stub\n",
+    ]
+    if language is not None:
+        lines.append(f"- #retranscribe/{language}\n")
+    lines += ["-\n", "- "]
+    lines += [f"[{start:.2f}s -> {start + 4:.2f}s] Synthetic segment {start // 4:.0f}.\n" for start in range(0, int(seconds), 4)]
+    lines.append("- Notes written after the transcription\n")
+    with open(path, "w") as f:
+        f.writelines(lines)
+
+# Function to build the fixture tree: new recordings in recordings/, and pages in logseq/pages of which
+# the first retranscribe_pages carry a #retranscribe tag and have their recording in recordings_backup/
+def build_fixtures(root, args):
+    for directory in ("recordings", "transcriptions", "recordings_backup", "logseq/pages", "logseq/assets", "obsidian"):
+        os.makedirs(os.path.join(root, directory), exist_ok=True)
+    for index in range(args.recordings):
+        stamp = (fixture_start + timedelta(hours=index)).strftime("%Y-%m-%d_%H-%M-%S")
+        write_recording(os.path.join(root, "recordings", f"{stamp}.wav"), args.seconds, args.seed * 1000003 + index)
+    for index in range(args.pages):
+        when = fixture_start - timedelta(hours=index + 1)
+        audio_name = f"{when.strftime('%Y-%m-%d_%H-%M-%S')} (transcribed).wav"
+        page_name = f"r___{when.year}___{when.month:02d}___{when.day:02d}  {when.strftime('%H.%M.%S')}  (1m0s).md"
+        language = None
+        if index < args.retranscribe_pages:
+            language = "fi"
+            write_recording(os.path.join(root, "recordings_backup", audio_name), args.page_seconds, args.seed * 1000003 + args.recordings + index)
+        write_page(os.path.join(root, "logseq", "pages", page_name), audio_name, args.page_seconds, language)
+
+# Filesystem operations under the scratch tree, from audit events and a wrapper around os.stat, which
+# has no audit event. os.path.exists and friends go through os.stat and are counted as stat.
+fs_ops = {}
+fs_audit_events = {
+    "open", "os.rename", "os.remove", "os.link", "os.symlink", "os.scandir", "os.listdir",
+    "os.mkdir", "os.rmdir", "os.utime", "os.truncate", "os.chmod", "shutil.copyfile",
+}
+
+def count_fs_ops(root):
+    root = os.fsencode(root)
+
+    def under_root(path):
+        try:
+            return os.fsencode(path).startswith(root)
+        except TypeError:
+            return False
+
+    def audit(event, args):
+        if event in fs_audit_events and args and under_root(args[0]):
+            fs_ops[event] = fs_ops.get(event, 0) + 1
+
+    stat = os.stat
+
+    def counted_stat(path, *rest, **options):
+        if under_root(path):
+            fs_ops["os.stat"] = fs_ops.get("os.stat", 0) + 1
+        return stat(path, *rest, **options)
+
+    sys.addaudithook(audit)
+    os.stat = counted_stat
+
+# Function to add up the stage timings the pipeline logged, per kind of run
+def read_stage_timings(timings_log_path):
+    stages = {}
+    per_file = []
+    if not os.path.exists(timings_log_path):
+        return stages, per_file
+    with open(timings_log_path) as f:
+        for line in f:
+            record = json.loads(line)
+            kind = stages.setdefault(record["kind"], {})
+            for stage, seconds in record["stages"].items():
+                kind[stage] = round(kind.get(stage, 0.0) + seconds, 3)
+            if record["real_time_factor"] is not None:
+                per_file.append(record["real_time_factor"])
+    return stages, per_file
+
+# The benchmark child: runs the one-shot pipeline on the scratch tree set up in its environment
+def run_child(root, result_path):
+    if os.environ.get("BENCHMARK_BACKEND") == "stub":
+        transcribe = install_stub_backend()
+    else:
+        import transcribe
+
+    audio_seconds = 0.0
+    recordings = [entry.path for entry in os.scandir(transcribe.recordings_dir) if transcribe.is_pending_recording(entry.name)]
+    for file_path in recordings:
+        with wave.open(file_path) as f:
+            audio_seconds += f.getnframes() / f.getframerate()
+
+    count_fs_ops(root)
+    started = time.perf_counter()
+    transcribe.retranscribe_files_in_logseq()
+    cold_scan_done = time.perf_counter()
+    transcribe.transcribe_files_in_directory()
+    transcribe.refiner.wait()
+    transcribe_done = time.perf_counter()
+    # Nothing changed since the first scan, this one shows what the page cache saves
+    transcribe.retranscribe_files_in_logseq()
+    finished = time.perf_counter()
+
+    stages, per_file = read_stage_timings(transcribe.timings_log_path)
+    transcribe_seconds = transcribe_done - cold_scan_done
+    result = {
+        "recordings": len(recordings),
+        "audio_seconds": round(audio_seconds, 3),
+        "wall_seconds": {
+            "page_scan_cold": round(cold_scan_done - started, 3),
+            "transcribe": round(transcribe_seconds, 3),
+            "page_scan_warm": round(finished - transcribe_done, 3),
+            "total": round(finished - started, 3),
+        },
+        "real_time_factor": round(transcribe_seconds / audio_seconds, 4) if audio_seconds else None,
+        "files_per_hour": round(len(recordings) / transcribe_seconds * 3600, 1) if transcribe_seconds else None,
+        "median_file_real_time_factor": round(statistics.median(per_file), 4) if per_file else None,
+        "stages": stages,
+        # ru_maxrss is in kilobytes on Linux; children covers the transcription worker processes
+        "peak_rss_bytes": {
+            "main": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+            "workers": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024,
+        },
+        "fs_ops": dict(sorted(fs_ops.items())),
+        "fs_ops_total": sum(fs_ops.values()),
+        "materialized_bytes": dict(transcribe.materialized_bytes),
+    }
+    with open(result_path, "w") as f:
+        json.dump(result, f, indent=2)
+
+# Function to run the pipeline once on a fresh copy of the fixtures, returning what the child measured
+def run_once(fixtures, work_dir, run, args):
+    root = os.path.join(work_dir, f"run{run}")
+    shutil.copytree(fixtures, root)
+    env = dict(
+        os.environ,
+        RECORDINGS_DIR=os.path.join(root, "recordings"),
+        TRANSCRIPTIONS_DIR=os.path.join(root, "transcriptions"),
+        RECORDINGS_BACKUP_DIR=os.path.join(root, "recordings_backup"),
+        LOGSEQ_DIR=os.path.join(root, "logseq"),
+        OBSIDIAN_DIR=os.path.join(root, "obsidian"),
+        AUDIO_CACHE_DIR=os.path.join(root, "audio_cache"),
+        STATE_DB=os.path.join(root, "state.sqlite3"),
+        TIMINGS_LOG=os.path.join(root, "timings.jsonl"),
+        TRANSCRIBE_DAEMON="false",
+        SHARED_RECORDINGS="false",
+        HTTP_PORT="0",
+        BENCHMARK_BACKEND=args.backend,
+        BENCHMARK_STUB_RTF=str(args.stub_rtf),
+    )
+    if args.backend == "stub":
+        # The batched pipeline drives the model internals the stub does not have
+        env["TRANSCRIBE_BATCH_SIZE"] = "0"
+    result_path = os.path.join(root, "result.json")
+    log_path = os.path.join(root, "pipeline.log")
+    with open(log_path, "w") as log:
+        child = subprocess.run(
+            [sys.executable, "-u", os.path.abspath(__file__), "--child", root, result_path],
+            env=env,
+            stdout=None if args.verbose else log,
+            stderr=subprocess.STDOUT,
+        )
+    if child.returncode != 0:
+        sys.exit(f"Benchmark run {run} failed, see {log_path}")
+    with open(result_path) as f:
+        return json.load(f)
+
+# Function to flatten nested results into dotted keys, for medians and comparisons
+def flatten(results, prefix=""):
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[f"{prefix}{key}"] = value
+    return flat
+
+def summarize(runs):
+    flat_runs = [flatten(run) for run in runs]
+    keys = sorted(set().union(*flat_runs))
+    return {key: statistics.median(run[key] for run in flat_runs if key in run) for key in keys}
+
+# Metrics where a larger number is better, everything else is a time, a size or a count
+higher_is_better = {"files_per_hour"}
+# Metrics checked by --max-regression
+headline_metrics = ("real_time_factor", "files_per_hour", "wall_seconds.total", "wall_seconds.page_scan_warm", "peak_rss_bytes.main", "fs_ops_total")
+
+# Function to print the change against a baseline, returns the headline metrics that got worse by more
+# than max_regression percent
+def compare(summary, baseline, max_regression):
+    regressions = []
+    print(f"{'metric':<48} {'baseline':>14} {'current':>14} {'change':>9}")
+    for key in sorted(set(summary) & set(baseline)):
+        before, after = baseline[key], summary[key]
+        change = (after - before) / before * 100 if before else 0.0
+        print(f"{key:<48} {before:>14.4g} {after:>14.4g} {change:>+8.1f}%")
+        worse = -change if key in higher_is_better else change
+        if max_regression is not None and key in headline_metrics and worse > max_regression:
+            regressions.append(key)
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the transcription pipeline on synthetic fixtures.")
+    parser.add_argument("--backend", choices=("stub", "model"), default="stub", help="stub model and VAD, or the real WHISPER_MODEL")
+    parser.add_argument("--stub-rtf", type=float, default=0.05, help="real-time factor the stub model simulates")
+    parser.add_argument("--recordings", type=int, default=10, help="new recordings to transcribe")
+    parser.add_argument("--seconds", type=float, default=60, help="length of each new recording")
+    parser.add_argument("--pages", type=int, default=500, help="Logseq pages in the page tree")
+    parser.add_argument("--retranscribe-pages", type=int, default=2, help="pages tagged #retranscribe")
+    parser.add_argument("--page-seconds", type=float, default=30, help="length of the recordings behind tagged pages")
+    parser.add_argument("--repeat", type=int, default=1, help="runs on fresh copies of the fixtures, results are medians")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--work-dir", help="scratch directory to keep, a temporary one is removed otherwise")
+    parser.add_argument("--output", default="benchmark.json", help="JSON file to write the results to")
+    parser.add_argument("--baseline", help="results JSON of an earlier run to compare against")
+    parser.add_argument("--max-regression", type=float, help="exit with an error if a headline metric got worse by more than this many percent")
+    parser.add_argument("--verbose", action="store_true", help="show the output of the pipeline")
+    parser.add_argument("--child", nargs=2, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(*args.child)
+        return
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="transcribe-benchmark-")
+    try:
+        fixtures = os.path.join(work_dir, "fixtures")
+        print(f"Writing {args.recordings} recordings of {args.seconds:g}s and {args.pages} pages to {fixtures}")
+        started = time.perf_counter()
+        build_fixtures(fixtures, args)
+        print(f"Fixtures written in {time.perf_counter() - started:.1f}s")
+
+        runs = []
+        for run in range(args.repeat):
+            runs.append(run_once(fixtures, work_dir, run, args))
+            print(f"Run {run + 1}/{args.repeat}: real-time factor {runs[-1]['real_time_factor']}, {runs[-1]['files_per_hour']} files/hour, {runs[-1]['wall_seconds']['total']}s")
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    summary = summarize(runs)
+    results = {
+        "time": datetime.now().isoformat(timespec="seconds"),
+        "config": {key: value for key, value in vars(args).items() if key not in ("child", "verbose")},
+        "settings": {key: os.environ[key] for key in transcribe_settings if key in os.environ},
+        "environment": {"python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count()},
+        "summary": summary,
+        "runs": runs,
+    }
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["summary"]
+        regressions = compare(summary, baseline, args.max_regression)
+        if regressions:
+            sys.exit(f"Regressed by more than {args.max_regression}%: {', '.join(regressions)}")
+
+if __name__ == "__main__":
+    main()
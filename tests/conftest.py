@@ -0,0 +1,75 @@
+import os
+import sys
+import json
+import subprocess
+
+import pytest
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# transcribe.py reads its configuration and creates its directories on import, so every test runs it in
+# a fresh interpreter pointed at a scratch tree under tmp_path
+@pytest.fixture
+def transcribe_env(tmp_path):
+    def make(**overrides):
+        env = dict(
+            os.environ,
+            PYTHONPATH=repo_dir,
+            RECORDINGS_DIR=str(tmp_path / "recordings"),
+            TRANSCRIPTIONS_DIR=str(tmp_path / "transcriptions"),
+            RECORDINGS_BACKUP_DIR=str(tmp_path / "recordings_backup"),
+            LOGSEQ_DIR=str(tmp_path / "logseq"),
+            OBSIDIAN_DIR=str(tmp_path / "obsidian"),
+            MODELS_DIR=str(tmp_path / "models"),
+            AUDIO_SPILL_DIR=str(tmp_path / "spill"),
+            AUDIO_CACHE_MAX_GB="0",
+            TRANSCRIBE_DAEMON="false",
+            HTTP_PORT="0",
+        )
+        env.update({name: str(value) for name, value in overrides.items()})
+        return env
+    return make
+
+# A script is either the source of a program or, when the spawned worker processes have to import it
+# as __mp_main__, the path of a file
+def child_command(script, args):
+    if isinstance(script, os.PathLike):
+        return [sys.executable, os.fspath(script), *map(str, args)]
+    return [sys.executable, "-c", script, *map(str, args)]
+
+# Function to check how a child went. result is the JSON object the child printed last, if it did.
+def completed_child(child, stdout, stderr, check):
+    if check:
+        assert child.returncode == 0, stdout + stderr
+    completed = subprocess.CompletedProcess(child.args, child.returncode, stdout, stderr)
+    lines = stdout.strip().splitlines()
+    try:
+        completed.result = json.loads(lines[-1]) if lines else None
+    except ValueError:
+        completed.result = None
+    return completed
+
+@pytest.fixture
+def start_child():
+    def start(script, *args, env):
+        return subprocess.Popen(child_command(script, args), env=env, cwd=repo_dir, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    return start
+
+@pytest.fixture
+def finish_child():
+    def wait(child, timeout=300, check=True):
+        stdout, stderr = child.communicate(timeout=timeout)
+        return completed_child(child, stdout, stderr, check)
+    return wait
+
+@pytest.fixture
+def run_child(start_child, finish_child):
+    def run(script, *args, env, timeout=300, check=True):
+        child = start_child(script, *args, env=env)
+        try:
+            return finish_child(child, timeout, check)
+        finally:
+            if child.poll() is None:
+                child.kill()
+                child.wait()
+    return run
@@ -0,0 +1,64 @@
+import re
+
+import pytest
+
+pytest.importorskip("numpy")
+pytest.importorskip("av")
+
+crash_after = 12
+
+# Transcribes a chunked recording. With a segment count it dies right after writing that segment, before
+# the checkpoint that would cover it. Without one it finishes the transcription, resuming what a previous
+# run left, and then transcribes the recording again from scratch for comparison.
+child_script = """
+import os
+import sys
+import json
+
+import benchmark
+import transcribe
+
+recording_path = os.path.join(transcribe.recordings_dir, "2024-01-02_10-00-00.wav")
+output_path = os.path.join(transcribe.transcriptions_dir, "2024-01-02_10-00-00.md")
+if len(sys.argv) > 1:
+    benchmark.write_recording(recording_path, 120, 1)
+    written = []
+    def crash(segment):
+        written.append(segment)
+        if len(written) == int(sys.argv[1]):
+            os._exit(3)
+    transcribe.transcribe_audio(recording_path, output_path, on_segment=crash)
+else:
+    transcribe.transcribe_audio(recording_path, output_path)
+    clean_path = os.path.join(transcribe.transcriptions_dir, "clean.md")
+    transcribe.transcribe_audio(recording_path, clean_path)
+    with open(output_path) as f, open(clean_path) as clean:
+        print(json.dumps({"text": f.read(), "clean": clean.read()}))
+"""
+
+SEGMENT_LINE = re.compile(r'\[(\d+\.\d+)s -> (\d+\.\d+)s\] .*')
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_interrupted_transcription_resumes_without_duplicates(transcribe_env, run_child, workers):
+    env = transcribe_env(
+        CHECKPOINT_INTERVAL=0,
+        CHUNK_THRESHOLD_SECONDS=60,
+        CHUNK_SECONDS=40,
+        CHUNK_WORKERS=workers,
+        BENCHMARK_BACKEND="stub",
+        BENCHMARK_STUB_RTF=0,
+    )
+    crashed = run_child(child_script, crash_after, env=env, check=False)
+    assert crashed.returncode == 3, crashed.stdout + crashed.stderr
+
+    resumed = run_child(child_script, env=env)
+    assert "Resuming" in resumed.stdout
+    lines = [match.group(0) for match in SEGMENT_LINE.finditer(resumed.result["text"])]
+    clean_lines = [match.group(0) for match in SEGMENT_LINE.finditer(resumed.result["clean"])]
+    assert len(set(lines)) == len(lines)
+    # What was checkpointed is kept as it was, the line written after the checkpoint is not repeated
+    assert lines[:crash_after - 1] == clean_lines[:crash_after - 1]
+    times = [tuple(map(float, SEGMENT_LINE.match(line).groups())) for line in lines]
+    for (start, end), (next_start, next_end) in zip(times, times[1:]):
+        assert end <= next_start, (start, end, next_start, next_end)
+    assert times[-1][1] == float(SEGMENT_LINE.match(clean_lines[-1]).group(2))
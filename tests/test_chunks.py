@@ -0,0 +1,49 @@
+import re
+
+import pytest
+
+pytest.importorskip("numpy")
+pytest.importorskip("av")
+
+# Transcribes a recording long enough to be split into chunks and reports the segment times it wrote
+child_script = """
+import os
+import json
+
+import benchmark
+import transcribe
+
+recording_path = os.path.join(transcribe.recordings_dir, "2024-01-02_10-00-00.wav")
+benchmark.write_recording(recording_path, 180, 1)
+audio, speech, mapping = transcribe.load_audio_and_speech(recording_path)
+chunks = transcribe.plan_chunks(speech, len(audio), transcribe.chunk_length(True))
+output_path = os.path.join(transcribe.transcriptions_dir, "2024-01-02_10-00-00.md")
+transcribe.transcribe_audio(recording_path, output_path)
+with open(output_path) as f:
+    text = f.read()
+speech_seconds = [[chunk["start"] / transcribe.sampling_rate, chunk["end"] / transcribe.sampling_rate] for chunk in speech]
+print(json.dumps({"chunks": len(chunks), "speech": speech_seconds, "text": text}))
+"""
+
+SEGMENT_LINE = re.compile(r'\[(\d+\.\d+)s -> (\d+\.\d+)s\]')
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_segments_stay_in_order_across_chunk_boundaries(transcribe_env, run_child, workers):
+    env = transcribe_env(
+        CHUNK_THRESHOLD_SECONDS=60,
+        CHUNK_SECONDS=40,
+        CHUNK_WORKERS=workers,
+        BENCHMARK_BACKEND="stub",
+        BENCHMARK_STUB_RTF=0,
+    )
+    result = run_child(child_script, env=env).result
+    assert result["chunks"] > 2
+
+    times = [(float(start), float(end)) for start, end in SEGMENT_LINE.findall(result["text"])]
+    assert times
+    # Every timestamp maps back into the speech it came from
+    for seconds in [seconds for segment in times for seconds in segment]:
+        assert any(start - 0.01 <= seconds <= end + 0.01 for start, end in result["speech"]), seconds
+    for (start, end), (next_start, next_end) in zip(times, times[1:]):
+        assert start < end
+        assert end <= next_start, (start, end, next_start, next_end)
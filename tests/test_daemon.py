@@ -0,0 +1,152 @@
+import os
+import sys
+import time
+import socket
+import subprocess
+
+import pytest
+
+pytest.importorskip("numpy")
+pytest.importorskip("av")
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# A watch daemon with the API, given one recording through the recordings directory and one through
+# the API while the first is being transcribed. Counts how many transcriptions run at once.
+api_script = """
+import os
+import json
+import time
+import threading
+import http.client
+
+import benchmark
+import transcribe
+
+lock = threading.Lock()
+running = 0
+most_running = 0
+transcribe_audio = transcribe.transcribe_audio
+def counted_transcribe_audio(*args, **kwargs):
+    global running, most_running
+    with lock:
+        running += 1
+        most_running = max(most_running, running)
+    try:
+        return transcribe_audio(*args, **kwargs)
+    finally:
+        with lock:
+            running -= 1
+transcribe.transcribe_audio = counted_transcribe_audio
+
+transcribe.start_http_server()
+threading.Thread(target=transcribe.run_daemon, daemon=True).start()
+time.sleep(1)
+
+# Written next to the recordings directory and moved in, so the watcher sees a finished file
+scratch_dir = os.path.dirname(transcribe.recordings_dir)
+watched_path = os.path.join(scratch_dir, "2024-01-02_10-00-00.wav")
+benchmark.write_recording(watched_path, 20, 1)
+os.replace(watched_path, os.path.join(transcribe.recordings_dir, os.path.basename(watched_path)))
+uploaded_path = os.path.join(scratch_dir, "2024-01-03_10-00-00.wav")
+benchmark.write_recording(uploaded_path, 20, 2)
+
+# Wait for the watched recording to start transcribing, then submit the other one
+deadline = time.monotonic() + 60
+while running == 0 and time.monotonic() < deadline:
+    time.sleep(0.05)
+connection = http.client.HTTPConnection("127.0.0.1", transcribe.http_port, timeout=120)
+with open(uploaded_path, "rb") as f:
+    connection.request("POST", "/transcribe?name=2024-01-03_10-00-00.wav", f.read(), {"Content-Type": "audio/wav"})
+response = connection.getresponse()
+events = [line[len("event: "):] for line in response.read().decode().splitlines() if line.startswith("event: ")]
+
+while time.monotonic() < deadline and sum("(transcribed)" in name for name in os.listdir(transcribe.recordings_dir)) < 2:
+    time.sleep(0.1)
+print(json.dumps({"status": response.status, "events": events, "most_running": most_running, "recordings": sorted(os.listdir(transcribe.recordings_dir))}))
+"""
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def test_api_and_watched_recordings_share_one_model_queue(transcribe_env, run_child):
+    env = transcribe_env(
+        TRANSCRIBE_DAEMON="true",
+        HTTP_PORT=free_port(),
+        WATCH_MODE="poll",
+        WATCH_POLL_INTERVAL=0.2,
+        WATCH_SETTLE_SECONDS=0.5,
+        BENCHMARK_BACKEND="stub",
+        # Two seconds a recording, long enough for the API job to arrive while the first one runs
+        BENCHMARK_STUB_RTF=0.1,
+    )
+    result = run_child(api_script, env=env, timeout=180).result
+    assert result["status"] == 200
+    assert result["events"][0] == "queued" and result["events"][-1] == "done", result
+    assert result["recordings"] == ["2024-01-02_10-00-00 (transcribed).wav", "2024-01-03_10-00-00 (transcribed).wav"]
+    assert result["most_running"] == 1
+
+# A watch daemon of a shared recordings volume. With an argument it marks when it has caught up, without
+# one it hangs in every transcription while holding the lease, as a node that is about to die would.
+node_script = """
+import sys
+import time
+
+import benchmark
+import transcribe
+
+if len(sys.argv) > 1:
+    report_startup_timings = transcribe.report_startup_timings
+    def report_and_mark():
+        report_startup_timings()
+        open(sys.argv[1], "w").close()
+    transcribe.report_startup_timings = report_and_mark
+else:
+    transcribe.transcribe_audio = lambda *args, **kwargs: time.sleep(3600)
+transcribe.run_daemon()
+"""
+
+def wait_for(condition, timeout):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.1)
+
+def test_recording_of_a_killed_node_is_taken_over(tmp_path, transcribe_env, start_child):
+    recordings_dir = tmp_path / "recordings"
+    recordings_dir.mkdir()
+    subprocess.run([sys.executable, "-c", "import sys, benchmark; benchmark.write_recording(sys.argv[1], 20, 1)", recordings_dir / "2024-01-02_10-00-00.wav"], cwd=repo_dir, check=True)
+
+    def node_env(name):
+        return transcribe_env(
+            TRANSCRIBE_DAEMON="true",
+            SHARED_RECORDINGS="true",
+            NODE_ID=name,
+            LEASE_TTL=3,
+            MODELS_DIR=tmp_path / name / "models",
+            AUDIO_SPILL_DIR=tmp_path / name / "spill",
+            WATCH_MODE="poll",
+            WATCH_POLL_INTERVAL=0.2,
+            BENCHMARK_BACKEND="stub",
+            BENCHMARK_STUB_RTF=0,
+        )
+
+    caught_up = tmp_path / "caught-up"
+    dying = start_child(node_script, env=node_env("node-a"))
+    survivor = None
+    try:
+        lease_dir = recordings_dir / ".leases"
+        wait_for(lambda: lease_dir.exists() and any(name.endswith(".lease") for name in os.listdir(lease_dir)), 60)
+        # The survivor finds the recording claimed when it starts, and only a rescan gets it to try again
+        survivor = start_child(node_script, caught_up, env=node_env("node-b"))
+        wait_for(caught_up.exists, 60)
+        dying.kill()
+        wait_for(lambda: os.path.exists(recordings_dir / "2024-01-02_10-00-00 (transcribed).wav"), 60)
+    finally:
+        for child in [dying, survivor]:
+            if child is not None:
+                child.kill()
+                child.communicate()
+    assert os.listdir(tmp_path / "transcriptions") != []
@@ -0,0 +1,26 @@
+import pytest
+
+pytest.importorskip("numpy")
+
+child_script = """
+import sys
+import json
+from types import SimpleNamespace
+
+import numpy as np
+
+import benchmark
+import transcribe
+
+model = benchmark.StubWhisperModel(0, multilingual=sys.argv[1] == "multilingual")
+loader = SimpleNamespace(get=lambda: model)
+audio = np.zeros(60 * transcribe.sampling_rate, dtype=np.float32)
+speech = [{"start": 0, "end": len(audio)}]
+print(json.dumps(transcribe.resolve_language(audio, speech, loader)))
+"""
+
+@pytest.mark.parametrize("model, expected", [("english-only", ["en", 1.0]), ("multilingual", ["en", 0.99])])
+def test_resolve_language(transcribe_env, run_child, model, expected):
+    language, probability = run_child(child_script, model, env=transcribe_env(), timeout=120).result
+    assert language == expected[0]
+    assert probability == pytest.approx(expected[1])
@@ -0,0 +1,61 @@
+import os
+import time
+
+import pytest
+
+pytest.importorskip("numpy")
+
+nodes = 4
+keys = 200
+ttl = 2.0
+
+# One node of the cluster: claims what it can once every node has started, keeps its leases alive
+# for a few ttls without releasing them, then exits as if it had crashed
+node_script = """
+import sys
+import json
+import time
+
+import transcribe
+
+lease_dir, owner, ttl, keys, start_at = sys.argv[1], sys.argv[2], float(sys.argv[3]), int(sys.argv[4]), float(sys.argv[5])
+leases = transcribe.LeaseManager(lease_dir, owner, ttl)
+while time.time() < start_at:
+    time.sleep(0.001)
+claimed = [key for key in (f"recording-{index}.wav" for index in range(keys)) if leases.acquire(key)]
+time.sleep(ttl * 3)
+print(json.dumps({"claimed": claimed, "held": [key for key in claimed if leases.holds(key)]}))
+"""
+
+def test_each_recording_is_claimed_once_and_reclaimed_after_the_ttl(tmp_path, transcribe_env, start_child, finish_child):
+    lease_dir = tmp_path / "leases"
+    # Interpreter start and imports take a while, every node starts claiming at the same moment
+    start_at = time.time() + 10
+    children = [start_child(node_script, lease_dir, f"node-{index}", ttl, keys, start_at, env=transcribe_env()) for index in range(nodes)]
+    results = [finish_child(child, timeout=120).result for child in children]
+
+    claimed = [key for result in results for key in result["claimed"]]
+    assert len(claimed) == keys
+    assert len(set(claimed)) == keys
+    # The heartbeat kept every lease past the ttl
+    for result in results:
+        assert result["held"] == result["claimed"]
+
+    # The nodes are gone and nothing renews their leases, a new node takes all of them over
+    time.sleep(ttl * 1.5)
+    result = finish_child(start_child(node_script, lease_dir, "node-new", ttl, keys, 0, env=transcribe_env()), timeout=120).result
+    assert sorted(result["claimed"]) == sorted(claimed)
+    leftovers = [name for name in os.listdir(lease_dir) if not name.endswith(".lease")]
+    assert leftovers == []
+
+def test_shared_mode_refuses_state_on_the_shared_volume(tmp_path, transcribe_env, run_child):
+    env = transcribe_env(SHARED_RECORDINGS="true", STATE_DB=tmp_path / "transcriptions" / "state.sqlite3")
+    child = run_child("import transcribe", env=env, timeout=120, check=False)
+    assert child.returncode != 0
+    assert "STATE_DB" in child.stderr
+
+def test_shared_mode_keeps_state_on_node_local_storage(tmp_path, transcribe_env, run_child):
+    script = "import json, transcribe; print(json.dumps([transcribe.state_db_path, transcribe.timings_log_path]))"
+    child = run_child(script, env=transcribe_env(SHARED_RECORDINGS="true"), timeout=120)
+    for path in child.result:
+        assert os.path.dirname(path) == str(tmp_path / "models" / "state")
@@ -0,0 +1,47 @@
+import pytest
+
+pytest.importorskip("numpy")
+pytest.importorskip("av")
+
+ceiling_mb = 32
+# Interpreter, imports, decode buffers and the chunk the stub model is given
+allowance_mb = 64
+hours = 3
+
+# Runs in a fresh interpreter, so the peak RSS it reports belongs to this pipeline run alone
+child_script = """
+import sys
+import json
+import resource
+
+import benchmark
+import transcribe
+
+def peak_rss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+path = sys.argv[1]
+benchmark.write_recording(path, float(sys.argv[2]), 1)
+before = peak_rss()
+audio, speech, mapping = transcribe.stream_audio_and_speech(path)
+duration_seconds = len(audio) / transcribe.sampling_rate
+segments = sum(1 for _ in transcribe.iter_segments(audio, speech, "en", 0.0, duration_seconds, transcribe.model_loader, mapping))
+print(json.dumps({"growth": peak_rss() - before, "samples": len(audio), "speech": len(speech), "segments": segments}))
+"""
+
+def test_long_recording_stays_under_memory_ceiling(tmp_path, transcribe_env, run_child):
+    env = transcribe_env(
+        MAX_AUDIO_MEMORY_MB=ceiling_mb,
+        CHUNK_THRESHOLD_SECONDS=0,
+        TRANSCRIBE_BATCH_SIZE=0,
+        BENCHMARK_BACKEND="stub",
+        BENCHMARK_STUB_RTF=0,
+    )
+    result = run_child(child_script, tmp_path / "long.wav", hours * 3600, env=env, timeout=600).result
+
+    pcm_bytes = result["samples"] * 4
+    assert result["samples"] == hours * 3600 * 16000
+    assert result["speech"] > 0 and result["segments"] > 0
+    # The decoded recording is many times the ceiling, the growth of the peak RSS is not
+    assert pcm_bytes > 10 * ceiling_mb * 1024 ** 2
+    assert result["growth"] < (ceiling_mb + allowance_mb) * 1024 ** 2, result
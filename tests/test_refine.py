@@ -0,0 +1,39 @@
+import pytest
+
+pytest.importorskip("numpy")
+pytest.importorskip("av")
+
+# A run in draft mode that also retranscribes a page, recording the nice value of the thread each model
+# is loaded from
+child_script = """
+import os
+import json
+import threading
+
+import benchmark
+import transcribe
+
+benchmark.write_recording(os.path.join(transcribe.recordings_dir, "2024-01-02_10-00-00.wav"), 20, 1)
+audio_name = "2024-01-01_10-00-00 (transcribed).wav"
+benchmark.write_recording(os.path.join(transcribe.recordings_backup_dir, audio_name), 20, 2)
+benchmark.write_page(os.path.join(transcribe.logseq_dir, "pages", "r___2024___01___01  10.00.00  (0m20s).md"), audio_name, 20, "fi")
+
+loads = []
+load_model = transcribe.load_model
+def recording_load_model(model_size, compute_type):
+    loads.append([model_size, os.getpriority(os.PRIO_PROCESS, threading.get_native_id())])
+    return load_model(model_size, compute_type)
+transcribe.load_model = recording_load_model
+
+transcribe.retranscribe_files_in_logseq()
+transcribe.transcribe_files_in_directory()
+transcribe.refiner.wait()
+print(json.dumps({"loads": loads, "niceness": os.getpriority(os.PRIO_PROCESS, 0)}))
+"""
+
+def test_refinement_model_is_loaded_at_lower_priority(transcribe_env, run_child):
+    env = transcribe_env(WHISPER_MODEL="full", DRAFT_MODEL="draft", REFINE_NICENESS=10, BENCHMARK_BACKEND="stub", BENCHMARK_STUB_RTF=0)
+    result = run_child(child_script, env=env).result
+    niceness = result["niceness"]
+    # Retranscription and the draft pass load their models at normal priority, refinement its own copy niced
+    assert sorted(result["loads"]) == [["draft", niceness], ["full", niceness], ["full", max(niceness, 10)]]
@@ -0,0 +1,42 @@
+import pytest
+
+pytest.importorskip("numpy")
+pytest.importorskip("av")
+
+# Transcribes a recording, puts the original back as a sync from another device would, and runs again
+# counting the filesystem calls that reach the output volumes
+child_script = """
+import os
+import json
+import shutil
+
+import benchmark
+import transcribe
+
+name = "2024-01-02_10-00-00"
+recording_path = os.path.join(transcribe.recordings_dir, name + ".wav")
+benchmark.write_recording(recording_path, 20, 1)
+shutil.copy(recording_path, recording_path + ".orig")
+transcribe.transcribe_files_in_directory()
+os.replace(recording_path + ".orig", recording_path)
+os.remove(os.path.join(transcribe.recordings_dir, name + " (transcribed).wav"))
+
+output_dirs = [transcribe.transcriptions_dir, transcribe.logseq_dir, transcribe.obsidian_dir, transcribe.recordings_backup_dir]
+probes = []
+stat = os.stat
+def counted_stat(path, *args, **kwargs):
+    if any(os.fspath(path).startswith(directory) for directory in output_dirs):
+        probes.append(os.fspath(path))
+    return stat(path, *args, **kwargs)
+os.stat = counted_stat
+transcribe.transcribe_files_in_directory()
+os.stat = stat
+
+print(json.dumps({"probes": probes, "recordings": sorted(os.listdir(transcribe.recordings_dir))}))
+"""
+
+def test_finished_audio_is_published_from_the_index(transcribe_env, run_child):
+    env = transcribe_env(BENCHMARK_BACKEND="stub", BENCHMARK_STUB_RTF=0)
+    result = run_child(child_script, env=env).result
+    assert result["recordings"] == ["2024-01-02_10-00-00 (transcribed).wav"]
+    assert result["probes"] == []
@@ -0,0 +1,85 @@
+import os
+
+import pytest
+
+pytest.importorskip("numpy")
+pytest.importorskip("av")
+
+recordings = [f"2024-01-0{day}_10-00-00" for day in range(1, 7)]
+crashing = recordings[0]
+
+# Run as a file so the spawned workers import it as __mp_main__ and get the stub model and the crash.
+# Only the workers swap transcribe_audio, the main process has to pickle the original.
+run_script = """
+import os
+import sys
+
+import benchmark
+import transcribe
+
+if __name__ == "__mp_main__":
+    transcribe_audio = transcribe.transcribe_audio
+
+    def crash_on(file_path, *args):
+        if os.path.basename(file_path).startswith(os.environ["CRASHING_RECORDING"]):
+            os._exit(1)
+        return transcribe_audio(file_path, *args)
+
+    transcribe.transcribe_audio = crash_on
+
+if __name__ == "__main__":
+    for name in sys.argv[1:]:
+        benchmark.write_recording(os.path.join(transcribe.recordings_dir, name + ".wav"), 20, 1)
+    transcribe.transcribe_files_in_directory()
+"""
+
+def test_dead_worker_does_not_abort_the_run(tmp_path, transcribe_env, run_child):
+    script_path = tmp_path / "run.py"
+    script_path.write_text(run_script)
+    env = transcribe_env(
+        TRANSCRIBE_WORKERS=2,
+        BENCHMARK_BACKEND="stub",
+        # Long enough that the pool is seen to break before the other worker finishes its recording
+        BENCHMARK_STUB_RTF=0.1,
+        CRASHING_RECORDING=crashing,
+    )
+    child = run_child(script_path, *recordings, env=env)
+    assert "starting a new worker pool" in child.stdout
+
+    left = sorted(os.listdir(tmp_path / "recordings"))
+    # The recording that killed its worker is left for the next run
+    assert f"{crashing}.wav" in left
+    # Only the recordings running on the broken pool fail, at most one per worker, the rest go to the new one
+    transcribed = [name for name in recordings if f"{name} (transcribed).wav" in left]
+    assert len(transcribed) >= len(recordings) - 2, child.stdout
+
+# The metrics the main process serves while and after a pool transcribes, parsed into name -> value
+metrics_script = """
+import os
+import sys
+import json
+
+import benchmark
+import transcribe
+
+if __name__ == "__main__":
+    for name in sys.argv[1:]:
+        benchmark.write_recording(os.path.join(transcribe.recordings_dir, name + ".wav"), 20, 1)
+    transcribe.transcribe_files_in_directory()
+    values = {}
+    for line in transcribe.metrics.render().splitlines():
+        if not line.startswith("#") and "{" not in line:
+            name, value = line.split()
+            values[name] = float(value)
+    print(json.dumps(values))
+"""
+
+def test_pool_workers_report_their_memory_and_model_load(tmp_path, transcribe_env, run_child):
+    script_path = tmp_path / "metrics.py"
+    script_path.write_text(metrics_script)
+    env = transcribe_env(TRANSCRIBE_WORKERS=2, BENCHMARK_BACKEND="stub", BENCHMARK_STUB_RTF=0)
+    values = run_child(script_path, *recordings[:3], env=env).result
+    # The workers load numpy and the model backend, far more than nothing
+    assert values["workers_peak_rss_bytes"] > 20 * 1024 ** 2
+    assert values["model_load_seconds"] >= 0
+    assert values["transcribe_files_total"] == 3
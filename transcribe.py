@@ -1,27 +1,304 @@
 print("Loading imports...")
  
+import time
+process_started = time.perf_counter()
+
 import os
 import re
 import shutil
-from faster_whisper import WhisperModel
-from pymediainfo import MediaInfo
+import ctypes
+import ctypes.util
+import select
+import struct
+import sqlite3
+import hashlib
+import json
+import threading
+import multiprocessing
+import numpy as np
+import bisect
+import dataclasses
+import contextlib
+import contextvars
+import http
+import asyncio
+import urllib.parse
+import resource
+import queue
+import fcntl
+import gc
+import mmap
+import socket
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime
+# faster_whisper and pymediainfo are imported where they are used, a run with no work never loads them
 
 # Get model size and type from WHISPER_MODEL environment variable
 # Example value for WHISPER_MODEL: "large-v2-float16" or "tiny-int8"
 model_size = os.getenv("WHISPER_MODEL", "large-v3")
 compute_type = os.getenv("WHISPER_COMPUTE_TYPE", "float32")
+# Optional fast draft model, e.g. "base". When set, recordings are first transcribed with it and marked
+# #draft, then WHISPER_MODEL refines the text in a lower priority background thread.
+draft_model_size = os.getenv("DRAFT_MODEL", "")
+draft_compute_type = os.getenv("DRAFT_COMPUTE_TYPE", "int8")
+refine_niceness = int(os.getenv("REFINE_NICENESS", "10"))
 reprocess_unprocessed = os.getenv("REPROCESS_UNPROCESSED", "false").lower() in ["true", "1"]
+# Number of VAD-selected speech windows scored when detecting the language of a recording
+language_detection_windows = int(os.getenv("LANGUAGE_DETECTION_WINDOWS", "3"))
+# Number of worker processes transcribing in parallel, and CPU threads per worker (0 = CTranslate2 default)
+transcribe_workers = int(os.getenv("TRANSCRIBE_WORKERS", "1"))
+cpu_threads = int(os.getenv("TRANSCRIBE_CPU_THREADS", "0"))
+# Seconds between checkpoints of a running transcription, a restart loses at most this much work
+checkpoint_interval = float(os.getenv("CHECKPOINT_INTERVAL", "30"))
+# Recordings longer than CHUNK_THRESHOLD_SECONDS are split at silences into chunks of about CHUNK_SECONDS
+# that are transcribed CHUNK_WORKERS at a time (0 disables chunking)
+chunk_threshold_seconds = float(os.getenv("CHUNK_THRESHOLD_SECONDS", "0"))
+chunk_seconds = float(os.getenv("CHUNK_SECONDS", "600"))
+chunk_workers = int(os.getenv("CHUNK_WORKERS", "2"))
+# Where models are downloaded to
+models_dir = os.getenv("MODELS_DIR", "/models")
+# Decoded audio and VAD cache used by retranscription, bounded to AUDIO_CACHE_MAX_GB (0 disables it)
+audio_cache_dir = os.getenv("AUDIO_CACHE_DIR", os.path.join(models_dir, "audio_cache"))
+audio_cache_max_bytes = int(float(os.getenv("AUDIO_CACHE_MAX_GB", "4")) * 1024 ** 3)
+# Ceiling for the decoded PCM of one recording held in memory. Recordings are decoded straight to a
+# float32 file that is memory-mapped, and VAD and inference work through it in windows sized to fit.
+# 0 decodes whole recordings in memory.
+max_audio_memory_bytes = int(float(os.getenv("MAX_AUDIO_MEMORY_MB", "256")) * 1024 ** 2)
+# Where recordings are decoded to when the audio cache is off
+audio_spill_dir = os.getenv("AUDIO_SPILL_DIR", audio_cache_dir)
+# Batch size for faster-whisper's batched inference pipeline (0 = sequential decoding, one window at a time)
+batch_size = int(os.getenv("TRANSCRIBE_BATCH_SIZE", "0"))
+# Watch mode: keep running and transcribe new recordings as they settle
+run_as_daemon = os.getenv("TRANSCRIBE_DAEMON", "false").lower() in ["true", "1"]
+watch_mode = os.getenv("WATCH_MODE", "auto").lower()  # auto, inotify or poll
+watch_poll_interval = float(os.getenv("WATCH_POLL_INTERVAL", "5"))
+watch_settle_seconds = float(os.getenv("WATCH_SETTLE_SECONDS", "2"))
+watch_tick_seconds = 0.25
+# Port of the HTTP server with the Prometheus metrics and, in watch mode, the transcription API (0 disables it)
+http_port = int(os.getenv("HTTP_PORT", os.getenv("METRICS_PORT", "10300")))
+# Jobs the API accepts before answering 429, the Retry-After it suggests then, and the largest upload
+api_queue_size = int(os.getenv("API_QUEUE_SIZE", "4"))
+api_retry_after = int(os.getenv("API_RETRY_AFTER", "30"))
+api_max_upload_bytes = int(float(os.getenv("API_MAX_UPLOAD_MB", "2048")) * 1024 ** 2)
+
+# Sample rate the Whisper models expect, and the length of one language detection window
+sampling_rate = 16000
+language_window_seconds = 30
+# Longest piece of speech the batched pipeline takes as one clip, a Whisper input window
+batch_clip_samples = 30 * sampling_rate
+# Samples of a recording processed at once under MAX_AUDIO_MEMORY_MB. A window is copied out of the
+# memory map and the model computes features of about the same size, so it gets a quarter of the
+# ceiling in float32 samples. Multiples of the 512 sample VAD frame.
+audio_window_samples = max_audio_memory_bytes // 16 // 512 * 512
+if max_audio_memory_bytes > 0:
+    audio_window_samples = max(audio_window_samples, 512)
+
+# Prometheus-style metrics of the main process, served as text on METRICS_PORT
+class Metrics:
+    stage_buckets = (0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 1800, 3600)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.gauges = {}
+        self.counters = {}
+        # stage -> (bucket counts, sum, count)
+        self.stage_histograms = {}
+
+    def set(self, name, value):
+        with self.lock:
+            self.gauges[name] = value
+
+    def inc(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe_stage(self, stage, seconds):
+        with self.lock:
+            buckets, total, count = self.stage_histograms.get(stage, ([0] * len(self.stage_buckets), 0.0, 0))
+            buckets = [n + (seconds <= bound) for n, bound in zip(buckets, self.stage_buckets)]
+            self.stage_histograms[stage] = (buckets, total + seconds, count + 1)
+
+    def render(self):
+        # The worker processes report their own with each result, see record_worker_stats
+        self.set("process_peak_rss_bytes", peak_rss_bytes())
+        lines = []
+        with self.lock:
+            for name, value in sorted(self.gauges.items()):
+                lines += [f"# TYPE {name} gauge", f"{name} {value}"]
+            for name, value in sorted(self.counters.items()):
+                lines += [f"# TYPE {name} counter", f"{name} {value}"]
+            if self.stage_histograms:
+                lines.append("# TYPE transcribe_stage_seconds histogram")
+            for stage, (buckets, total, count) in sorted(self.stage_histograms.items()):
+                for bound, n in zip(self.stage_buckets, buckets):
+                    lines.append(f'transcribe_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {n}')
+                lines.append(f'transcribe_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {count}')
+                lines.append(f'transcribe_stage_seconds_sum{{stage="{stage}"}} {total}')
+                lines.append(f'transcribe_stage_seconds_count{{stage="{stage}"}} {count}')
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+# ru_maxrss is in kilobytes on Linux
+def peak_rss_bytes():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+# Resource use of the transcription worker processes by process id, as they last reported it.
+# RUSAGE_CHILDREN only covers children that have exited, so a running pool would show nothing.
+worker_stats = {}
+
+# Function to record the stats a worker sent with a result: its peak RSS, and how long it took to load
+# its model. Workers load in parallel, so the slowest load is what the model load cost.
+def record_worker_stats(stats, loader):
+    worker_stats[stats["pid"]] = stats
+    metrics.set("workers_peak_rss_bytes", max(worker["peak_rss_bytes"] for worker in worker_stats.values()))
+    load_seconds = max((worker["model_load_seconds"] for worker in worker_stats.values() if worker["model_load_seconds"] is not None), default=None)
+    if load_seconds is not None:
+        metrics.set(loader.metric_name, round(load_seconds, 3))
+        if "model_load" not in startup_timings:
+            record_startup("model_load", load_seconds)
+
+# Per-file stage timings. Each file being processed gets a dict of stage -> seconds in this context
+# variable, and timed() adds to it. Worker processes return their dict with the transcription result.
+file_timings = contextvars.ContextVar("file_timings", default=None)
+
+@contextlib.contextmanager
+def timed(stage):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings = file_timings.get()
+        if timings is not None:
+            timings[stage] = timings.get(stage, 0.0) + time.perf_counter() - started
+
+@contextlib.contextmanager
+def collect_timings(timings):
+    token = file_timings.set(timings)
+    try:
+        yield timings
+    finally:
+        file_timings.reset(token)
+
+# Function to time how long a generator spends producing its items, excluding the consumer's time
+def timed_iter(stage, items):
+    items = iter(items)
+    while True:
+        with timed(stage):
+            item = next(items, None)
+        if item is None:
+            return
+        yield item
 
-# Initialize the Whisper model
-model = WhisperModel(model_size, device="cpu", compute_type=compute_type, download_root="/models")
+# Function to write the stage timings of a finished file as a JSON line and add them to the metrics
+def record_file_timings(kind, file_path, timings, audio_seconds):
+    total = sum(timings.values())
+    for stage, seconds in timings.items():
+        metrics.observe_stage(stage, seconds)
+    metrics.inc("transcribe_files_total")
+    if audio_seconds:
+        metrics.inc("transcribe_audio_seconds_total", audio_seconds)
+    record = {
+        "time": datetime.now().isoformat(timespec="seconds"),
+        "kind": kind,
+        "file": file_path,
+        "audio_seconds": audio_seconds,
+        "stages": {stage: round(seconds, 3) for stage, seconds in timings.items()},
+        "total_seconds": round(total, 3),
+        "real_time_factor": round(total / audio_seconds, 4) if audio_seconds else None,
+    }
+    try:
+        with open(timings_log_path, "a") as f:
+            f.write(json.dumps(record) + "\n")
+    except OSError as e:
+        print(f"Could not write timings to {timings_log_path}: {e}")
+
+# Startup phases of this run in seconds, reported at the end and exported as metrics
+startup_timings = {}
+
+def record_startup(phase, seconds):
+    startup_timings[phase] = startup_timings.get(phase, 0.0) + seconds
+    metrics.set(f"startup_{phase}_seconds", round(startup_timings[phase], 3))
+
+record_startup("imports", time.perf_counter() - process_started)
+
+def report_startup_timings():
+    summary = ", ".join(f"{phase.replace('_', ' ')} {seconds:.1f}s" for phase, seconds in startup_timings.items())
+    if "model_load" not in startup_timings:
+        summary += ", model not loaded"
+    print(f"Startup: {summary}")
+
+def load_model(model_size, compute_type):
+    from faster_whisper import WhisperModel
+
+    # num_workers lets several chunks of one recording run through the model at the same time
+    num_workers = chunk_workers if chunk_threshold_seconds > 0 else 1
+    return WhisperModel(model_size, device="cpu", compute_type=compute_type, cpu_threads=cpu_threads, num_workers=num_workers, download_root=models_dir)
+
+# The Whisper model is loaded on demand. prefetch() starts loading it in a background thread as soon as
+# the first job is found, so the load overlaps with scanning pages and probing recordings; get() waits
+# for it. A run that finds nothing to do never loads the model.
+class ModelLoader:
+    def __init__(self, model_size, compute_type, metric_name="model_load_seconds"):
+        self.model_size = model_size
+        self.compute_type = compute_type
+        self.metric_name = metric_name
+        self.lock = threading.Lock()
+        self.thread = None
+        self.model = None
+        self.error = None
+        self.batched_pipeline = None
+
+    def prefetch(self):
+        with self.lock:
+            if self.thread is None:
+                print(f"Loading model {self.model_size} in the background")
+                self.thread = threading.Thread(target=self.load, daemon=True)
+                self.thread.start()
 
-# Define directories for recordings, transcriptions, and logseq-transcribe
-recordings_dir = "/recordings"
-transcriptions_dir = "/transcriptions"
-recordings_backup_dir = "/recordings_backup"
-logseq_dir = "/logseq"
-obsidian_dir = "/obsidian"
+    def load(self):
+        started = time.perf_counter()
+        try:
+            self.model = load_model(self.model_size, self.compute_type)
+        except Exception as e:
+            self.error = e
+            return
+        seconds = time.perf_counter() - started
+        metrics.set(self.metric_name, round(seconds, 3))
+        record_startup("model_load", seconds)
+
+    def get(self):
+        if self.model is None:
+            self.prefetch()
+            started = time.perf_counter()
+            self.thread.join()
+            record_startup("model_wait", time.perf_counter() - started)
+            if self.error is not None:
+                raise self.error
+        return self.model
+
+# Each worker process has its own loaders and loads its own model in init_worker
+model_loader = ModelLoader(model_size, compute_type)
+draft_loader = ModelLoader(draft_model_size, draft_compute_type, "draft_model_load_seconds") if draft_model_size else None
+# Refinement has a copy of WHISPER_MODEL of its own that only the refiner thread loads, so the inference
+# threads of that copy inherit its nice value. Retranscribing a page loads model_loader at normal priority.
+refine_loader = ModelLoader(model_size, compute_type, "refine_model_load_seconds")
+
+# The model new recordings are transcribed with first: the draft model when one is configured
+def first_pass_loader():
+    return draft_loader if draft_loader is not None else model_loader
+
+def init_worker():
+    first_pass_loader().get()
+
+# Define directories for recordings, transcriptions, and logseq-transcribe.
+# The container mounts volumes at the defaults, the benchmark points them at a scratch tree.
+recordings_dir = os.getenv("RECORDINGS_DIR", "/recordings")
+transcriptions_dir = os.getenv("TRANSCRIPTIONS_DIR", "/transcriptions")
+recordings_backup_dir = os.getenv("RECORDINGS_BACKUP_DIR", "/recordings_backup")
+logseq_dir = os.getenv("LOGSEQ_DIR", "/logseq")
+obsidian_dir = os.getenv("OBSIDIAN_DIR", "/obsidian")
 
 # Ensure the transcription and logseq-transcribe directories exist
 os.makedirs(transcriptions_dir, exist_ok=True)
@@ -33,21 +310,188 @@ os.makedirs(os.path.join(logseq_dir, "assets"), exist_ok=True)
 os.makedirs(obsidian_dir, exist_ok=True)
 os.makedirs(os.path.join(obsidian_dir, "r"), exist_ok=True)
 
+# Several containers can share one /recordings volume. With SHARED_RECORDINGS each recording is claimed
+# with a lease file in LEASE_DIR before anything is done with it, so it is transcribed by one node only.
+# A lease that has not been renewed for LEASE_TTL seconds belongs to a node that went away.
+shared_recordings = os.getenv("SHARED_RECORDINGS", "false").lower() in ["true", "1"]
+lease_dir = os.getenv("LEASE_DIR", os.path.join(recordings_dir, ".leases"))
+lease_ttl = float(os.getenv("LEASE_TTL", "120"))
+node_id = os.getenv("NODE_ID", socket.gethostname())
+# Watch mode scans the recordings directory again this often, so a recording whose claim or transcription
+# failed is retried, including the ones a node that went away held a lease on (0 disables it)
+rescan_interval = float(os.getenv("RESCAN_INTERVAL", str(lease_ttl) if shared_recordings else "600"))
+
+# The state index and the timings log are written by this node only. SQLite locking is not reliable on a
+# network filesystem and appends from several nodes interleave, so with SHARED_RECORDINGS they are kept
+# in LOCAL_STATE_DIR, which sits next to the audio cache on the node's own models volume.
+local_state_dir = os.getenv("LOCAL_STATE_DIR", os.path.join(models_dir, "state") if shared_recordings else transcriptions_dir)
+os.makedirs(local_state_dir, exist_ok=True)
+
+# JSON lines with the per-stage timings of every processed file
+timings_log_path = os.getenv("TIMINGS_LOG", os.path.join(local_state_dir, ".timings.jsonl"))
+
+# Job state index, keyed by a hash of the audio content so a renamed or copied recording is recognised
+state_db_path = os.getenv("STATE_DB", os.path.join(local_state_dir, ".transcribe_state.sqlite3"))
+
+# Function to check whether a path lies inside one of the directories every node writes to
+def on_shared_tree(path):
+    path = os.path.realpath(path)
+    for shared_dir in [recordings_dir, transcriptions_dir, recordings_backup_dir, logseq_dir, obsidian_dir]:
+        shared_dir = os.path.realpath(shared_dir)
+        if os.path.commonpath([path, shared_dir]) == shared_dir:
+            return True
+    return False
+
+if shared_recordings:
+    for name, path in [("STATE_DB", state_db_path), ("TIMINGS_LOG", timings_log_path)]:
+        if on_shared_tree(path):
+            raise SystemExit(f"{name} {path} is on the shared volumes, with SHARED_RECORDINGS it has to be on node-local storage.")
+
+class StateStore:
+    def __init__(self, path):
+        # Shared between the daemon and its helper threads, every access goes through the lock
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.lock = threading.Lock()
+        with self.lock, self.db:
+            self.db.execute("""
+                CREATE TABLE IF NOT EXISTS recordings (
+                    content_hash TEXT PRIMARY KEY,
+                    status TEXT NOT NULL,
+                    source_path TEXT,
+                    duration TEXT,
+                    language TEXT,
+                    language_probability TEXT,
+                    model TEXT,
+                    transcription_path TEXT,
+                    logseq_path TEXT,
+                    obsidian_path TEXT,
+                    backup_path TEXT,
+                    created_at REAL,
+                    updated_at REAL
+                )""")
+            # Remembers the hash of each path so unchanged files are only stat'ed, not read again
+            self.db.execute("""
+                CREATE TABLE IF NOT EXISTS files (
+                    path TEXT PRIMARY KEY,
+                    size INTEGER,
+                    mtime_ns INTEGER,
+                    content_hash TEXT
+                )""")
+            # Parsed tags, audio link and transcription block of each Logseq page, keyed by size and mtime
+            self.db.execute("""
+                CREATE TABLE IF NOT EXISTS pages (
+                    path TEXT PRIMARY KEY,
+                    size INTEGER,
+                    mtime_ns INTEGER,
+                    parsed TEXT
+                )""")
+
+    # The content hash covers the size and hash_blocks blocks spread evenly over the file, so a new
+    # recording on a network volume costs a few reads instead of a second full read next to decoding.
+    # Files no longer than those blocks together are hashed whole.
+    hash_blocks = 16
+    hash_block_size = 64 * 1024
+
+    def hash_file(self, path):
+        stat = os.stat(path)
+        with self.lock:
+            row = self.db.execute("SELECT size, mtime_ns, content_hash FROM files WHERE path = ?", (path,)).fetchone()
+        if row is not None and row["size"] == stat.st_size and row["mtime_ns"] == stat.st_mtime_ns:
+            return row["content_hash"]
+
+        digest = hashlib.sha256(str(stat.st_size).encode())
+        with open(path, "rb") as f:
+            if stat.st_size <= self.hash_blocks * self.hash_block_size:
+                digest.update(f.read())
+            else:
+                last = stat.st_size - self.hash_block_size
+                for index in range(self.hash_blocks):
+                    digest.update(os.pread(f.fileno(), self.hash_block_size, last * index // (self.hash_blocks - 1)))
+        content_hash = digest.hexdigest()
+        self.remember_file(path, content_hash, stat)
+        return content_hash
+
+    # Records the hash of a file whose content is already known, e.g. after a rename or copy
+    def remember_file(self, path, content_hash, stat=None):
+        stat = stat or os.stat(path)
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO files (path, size, mtime_ns, content_hash) VALUES (?, ?, ?, ?)",
+                (path, stat.st_size, stat.st_mtime_ns, content_hash),
+            )
+
+    # Returns the cached parse of a page, or None when the page changed since it was parsed
+    def get_page(self, path, stat):
+        with self.lock:
+            row = self.db.execute("SELECT size, mtime_ns, parsed FROM pages WHERE path = ?", (path,)).fetchone()
+        if row is None or row["size"] != stat.st_size or row["mtime_ns"] != stat.st_mtime_ns:
+            return None
+        return json.loads(row["parsed"])
+
+    def set_page(self, path, stat, parsed):
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO pages (path, size, mtime_ns, parsed) VALUES (?, ?, ?, ?)",
+                (path, stat.st_size, stat.st_mtime_ns, json.dumps(parsed)),
+            )
+
+    # Drops cached pages that no longer exist
+    def prune_pages(self, existing_paths):
+        with self.lock:
+            cached = {row["path"] for row in self.db.execute("SELECT path FROM pages")}
+        removed = cached - existing_paths
+        if removed:
+            with self.lock, self.db:
+                self.db.executemany("DELETE FROM pages WHERE path = ?", [(path,) for path in removed])
+
+    def get(self, content_hash):
+        with self.lock:
+            row = self.db.execute("SELECT * FROM recordings WHERE content_hash = ?", (content_hash,)).fetchone()
+        return dict(row) if row is not None else None
+
+    def update(self, content_hash, **fields):
+        now = time.time()
+        fields["updated_at"] = now
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT OR IGNORE INTO recordings (content_hash, status, created_at) VALUES (?, ?, ?)",
+                (content_hash, fields.get("status", "new"), now),
+            )
+            assignments = ", ".join(f"{name} = ?" for name in fields)
+            self.db.execute(
+                f"UPDATE recordings SET {assignments} WHERE content_hash = ?",
+                (*fields.values(), content_hash),
+            )
+
+# Only the main process keeps the index, worker processes just transcribe
+state = StateStore(state_db_path) if multiprocessing.parent_process() is None else None
+
 # Function to get the media duration in (XhYmZs) format
 def get_duration(file_path):
+    return format_duration(get_duration_seconds(file_path))
+
+# Function to get the media duration in seconds, or None when there is no audio track
+def get_duration_seconds(file_path):
+    from pymediainfo import MediaInfo
+
     media_info = MediaInfo.parse(file_path)
     for track in media_info.tracks:
         if track.track_type == 'Audio':
-            duration_in_ms = track.duration
-            duration_in_seconds = int(duration_in_ms / 1000)
-            hours = duration_in_seconds // 3600
-            minutes = (duration_in_seconds % 3600) // 60
-            seconds = duration_in_seconds % 60
-            if hours > 0:
-                return f"{hours}h{minutes}m{seconds}s"
-            else:
-                return f"{minutes}m{seconds}s"
-    return ""
+            return track.duration / 1000
+    return None
+
+def format_duration(duration_in_seconds):
+    if duration_in_seconds is None:
+        return ""
+    duration_in_seconds = int(duration_in_seconds)
+    hours = duration_in_seconds // 3600
+    minutes = (duration_in_seconds % 3600) // 60
+    seconds = duration_in_seconds % 60
+    if hours > 0:
+        return f"{hours}h{minutes}m{seconds}s"
+    else:
+        return f"{minutes}m{seconds}s"
 
 def get_renamed_file_dir_and_name(file_path):
     file_dir, file_name = os.path.split(file_path)
@@ -60,12 +504,73 @@ def get_renamed_file_dir_and_name(file_path):
 
     return file_dir, new_name
 
+# Output materialisation. Every artifact is written once and then placed in the other directories with
+# the first strategy in MATERIALIZE_STRATEGIES that works: a reflink (copy-on-write clone, FICLONE), a
+# hardlink when allowed and on the same filesystem, or a plain copy, e.g. across devices. Markdown pages
+# are never hardlinked because Logseq and Obsidian edit them in place. Each destination is written
+# under a temporary name and renamed into place.
+materialize_strategies = [name.strip() for name in os.getenv("MATERIALIZE_STRATEGIES", "reflink,hardlink,copy").split(",") if name.strip()]
+FICLONE = 0x40049409
+materialized_bytes = {"reflinked": 0, "hardlinked": 0, "copied": 0}
+materialized_bytes_lock = threading.Lock()
+
+def reflink_file(src, dst):
+    with open(src, "rb") as src_file, open(dst, "wb") as dst_file:
+        fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+
+def copy_file(src, dst):
+    shutil.copyfile(src, dst)
+
+materialize_methods = {
+    "reflink": ("reflinked", reflink_file),
+    "hardlink": ("hardlinked", os.link),
+    "copy": ("copied", copy_file),
+}
+
+def materialize(src, dst, allow_hardlink=False):
+    dst_dir, dst_name = os.path.split(dst)
+    tmp_path = os.path.join(dst_dir, f".{dst_name}.{os.getpid()}.{threading.get_native_id()}.tmp")
+    size = os.path.getsize(src)
+    for strategy in materialize_strategies:
+        if strategy == "hardlink" and not allow_hardlink:
+            continue
+        method, place = materialize_methods[strategy]
+        try:
+            place(src, tmp_path)
+        except OSError:
+            # Not supported here or across devices, try the next strategy
+            if os.path.lexists(tmp_path):
+                os.remove(tmp_path)
+            if strategy == materialize_strategies[-1]:
+                raise
+            continue
+        os.replace(tmp_path, dst)
+        with materialized_bytes_lock:
+            materialized_bytes[method] += size
+        metrics.inc(f"transcribe_bytes_{method}_total", size)
+        return method
+    raise OSError(f"No materialisation strategy could place {src} at {dst}")
+
+# Function to replace a file's content atomically, readers see either the old or the new file.
+# The temporary name is per thread, the refiner, the API worker and the main thread all write pages.
+def write_file_atomic(path, content):
+    file_dir, file_name = os.path.split(path)
+    tmp_path = os.path.join(file_dir, f".{file_name}.{os.getpid()}.{threading.get_native_id()}.tmp")
+    with open(tmp_path, "w") as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+def report_materialized_bytes():
+    with materialized_bytes_lock:
+        summary = ", ".join(f"{size / 1024 ** 2:.1f} MB {method}" for method, size in materialized_bytes.items())
+    print(f"Output fan-out: {summary}")
+
 # Function to rename the original audio file by appending (transcribed)
 def rename_file_as_transcribed(file_path, new_file_path):
     os.rename(file_path, new_file_path)
 
+# Lazily drops unusable segments, so segments can be written out as the model produces them
 def filter_segments(segments):
-    filtered = []
     for s in segments:
         dur = s.end - s.start
         text = s.text.strip()
@@ -82,168 +587,1062 @@ def filter_segments(segments):
         if getattr(s, "avg_logprob", None) is not None and s.avg_logprob < -1.0:
             continue
 
-        filtered.append(s)
-    return filtered
+        yield s
+
+
+# Function to decode an audio file once into 16 kHz mono PCM, shared by all later stages
+def load_audio(file_path):
+    from faster_whisper.audio import decode_audio
+
+    return decode_audio(file_path, sampling_rate=sampling_rate)
+
+# Function to decode a recording to a file of 16 kHz mono float32 samples, a block of frames at a time,
+# the same way faster-whisper's decode_audio does in memory
+def decode_audio_to_file(file_path, pcm_path):
+    import av
 
+    resampler = av.audio.resampler.AudioResampler(format="s16", layout="mono", rate=sampling_rate)
+    fifo = av.audio.fifo.AudioFifo()
 
-# Function to transcribe audio files
-def transcribe_audio(file_path, output_file):
+    def write(frames):
+        for frame in frames:
+            f.write((frame.to_ndarray().ravel().astype(np.float32) / 32768.0).tobytes())
+
+    with av.open(file_path, mode="r", metadata_errors="ignore") as container, open(pcm_path, "wb") as f:
+        frames = container.decode(audio=0)
+        while True:
+            try:
+                frame = next(frames)
+            except StopIteration:
+                break
+            except av.error.InvalidDataError:
+                continue
+            # Ignore timestamp checks, like faster-whisper
+            frame.pts = None
+            fifo.write(frame)
+            if fifo.samples >= 500000:
+                write(resampler.resample(fifo.read()))
+        if fifo.samples > 0:
+            write(resampler.resample(fifo.read()))
+        # Flush the resampler
+        write(resampler.resample(None))
+    # The resampler is not always freed without a collection, see faster-whisper issue 390
+    del resampler
+    gc.collect()
+
+# Function to memory-map a file of float32 samples. Returns the samples, a read-only view of the
+# mapping, and the mapping itself for release_audio.
+def map_pcm_file(pcm_path):
+    with open(pcm_path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return np.zeros(0, dtype=np.float32), None
+        # The mapping stays valid after the file is closed or removed
+        mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return np.frombuffer(mapping, dtype=np.float32), mapping
+
+# Function to drop the pages of a memory-mapped recording between two sample offsets from the resident
+# set once they have been processed. They are clean pages of the PCM file and are read back if needed.
+# mapping is None for audio decoded in memory, which has nothing to release.
+def release_audio(mapping, start, end):
+    if mapping is None:
+        return
+    itemsize = np.dtype(np.float32).itemsize
+    first = start * itemsize // mmap.PAGESIZE * mmap.PAGESIZE
+    last = min(end * itemsize, len(mapping)) // mmap.PAGESIZE * mmap.PAGESIZE
+    if last > first:
+        mapping.madvise(mmap.MADV_DONTNEED, first, last - first)
+
+# Function to run Silero VAD on audio that fits in memory. When recordings are chunked, speech running
+# on for longer than a chunk is split at the last short pause Silero finds in it, so that plan_chunks
+# can always end a chunk between two speech segments instead of in the middle of a word. In batched
+# mode speech is split the same way into pieces that fit one Whisper window.
+def speech_timestamps(audio):
+    from faster_whisper.vad import VadOptions, get_speech_timestamps
+
+    max_speech_samples = float("inf")
+    if chunk_threshold_seconds > 0 or audio_window_samples > 0:
+        max_speech_samples = chunk_length(chunk_threshold_seconds > 0)
+    if batch_size > 0:
+        max_speech_samples = min(max_speech_samples, batch_clip_samples)
+    options = VadOptions(max_speech_duration_s=max_speech_samples / sampling_rate)
+    return get_speech_timestamps(audio, options, sampling_rate=sampling_rate)
+
+# Function to find the speech in a recording, as a list of {"start", "end"} sample offsets.
+# Long recordings go through VAD a window at a time, VAD copies and pads all the audio it is given.
+def detect_speech(audio, mapping=None):
+    window = audio_window_samples if audio_window_samples > 0 else len(audio)
+    speech = []
+    for window_start in range(0, len(audio), max(window, 1)):
+        chunks = speech_timestamps(np.asarray(audio[window_start:window_start + window]))
+        for index, chunk in enumerate(chunks):
+            chunk = {"start": int(chunk["start"]) + window_start, "end": int(chunk["end"]) + window_start}
+            # Speech running over a window boundary comes back as two pieces that meet at the boundary.
+            # They are joined again even if that makes the speech longer than a chunk: the chunk
+            # holding it grows a little, which is better than cutting a word in two.
+            if index == 0 and speech and speech[-1]["end"] >= window_start - 1 and chunk["start"] <= window_start + 1:
+                speech[-1]["end"] = chunk["end"]
+            else:
+                speech.append(chunk)
+        release_audio(mapping, window_start, window_start + window)
+    return speech
+
+# Content-addressed cache of decoded PCM and VAD speech timestamps, so retranscribing a recording
+# skips decoding and VAD. Entries are evicted least recently used first once the cache grows past max_bytes.
+class AudioCache:
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def paths(self, content_hash):
+        base = os.path.join(self.directory, content_hash)
+        return base + ".f32", base + ".json"
+
+    def load(self, content_hash):
+        pcm_path, speech_path = self.paths(content_hash)
+        try:
+            with open(speech_path) as f:
+                speech = json.load(f)
+            audio, mapping = map_pcm_file(pcm_path)
+        except (FileNotFoundError, ValueError):
+            return None
+        # The mtime of the PCM file is the last use time for eviction
+        os.utime(pcm_path)
+        return audio, speech, mapping
+
+    # Temporary name to write the PCM of an entry under, several worker processes may share the cache
+    def temporary_path(self, content_hash, kind=".f32"):
+        return os.path.join(self.directory, f"{content_hash}{kind}.{os.getpid()}.{threading.get_native_id()}.tmp")
+
+    def store(self, content_hash, audio, speech):
+        pcm_tmp_path = self.temporary_path(content_hash)
+        audio.astype(np.float32, copy=False).tofile(pcm_tmp_path)
+        self.store_file(content_hash, pcm_tmp_path, speech)
+
+    # Function to add an entry whose PCM was already written to temporary_path
+    def store_file(self, content_hash, pcm_tmp_path, speech):
+        pcm_path, speech_path = self.paths(content_hash)
+        speech_tmp_path = self.temporary_path(content_hash, ".json")
+        with open(speech_tmp_path, "w") as f:
+            json.dump(speech, f)
+        os.replace(speech_tmp_path, speech_path)
+        os.replace(pcm_tmp_path, pcm_path)
+        self.evict()
+
+    def evict(self):
+        entries = []
+        total = 0
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith(".f32"):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total += stat.st_size
+        for _, size, pcm_path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            for path in (pcm_path, pcm_path[:-len(".f32")] + ".json"):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            total -= size
+
+audio_cache = AudioCache(audio_cache_dir, audio_cache_max_bytes) if audio_cache_max_bytes > 0 else None
+
+# Function to get the decoded audio and speech timestamps of a recording, from the cache when possible.
+# Also returns the memory mapping holding the audio, or None when it was decoded in memory.
+def load_audio_and_speech(file_path, content_hash=None):
+    if audio_cache is not None and content_hash is not None:
+        with timed("audio_cache"):
+            cached = audio_cache.load(content_hash)
+        if cached is not None:
+            print(f"Using cached audio and VAD for {file_path}")
+            return cached
+    if max_audio_memory_bytes > 0:
+        return stream_audio_and_speech(file_path, content_hash)
+
+    with timed("decode"):
+        audio = load_audio(file_path)
+    with timed("vad"):
+        speech = detect_speech(audio)
+    if audio_cache is not None and content_hash is not None:
+        audio_cache.store(content_hash, audio, speech)
+    return audio, speech, None
+
+# Function to decode a recording to disk and memory-map it, so its length does not count against memory.
+# With the audio cache the PCM is written straight into a cache entry, otherwise to a spill file that is
+# unlinked once mapped.
+def stream_audio_and_speech(file_path, content_hash=None):
+    cached = audio_cache is not None and content_hash is not None
+    if cached:
+        pcm_path = audio_cache.temporary_path(content_hash)
+    else:
+        os.makedirs(audio_spill_dir, exist_ok=True)
+        pcm_path = os.path.join(audio_spill_dir, f".spill.{os.getpid()}.{threading.get_native_id()}.f32")
     try:
-        segments, info = model.transcribe(
-            file_path,
-            task="transcribe",
-            beam_size=5,
-            best_of=5,
-            vad_filter=True,
-            no_speech_threshold=0.4,
-            log_prob_threshold=-0.5,
-            temperature=0.0,
-        )
-
-        segments = filter_segments(segments)
-
-        probability = None
-        if float(info.language_probability) < 0.9 and info.language != "en":
-            print(f"Detected language '{info.language}' with probability {info.language_probability}. The detected language is likely wrong, transcribing again to english.")
-            segments, info = model.transcribe(
-                file_path,
-                task="transcribe",
-                language="en",
-                beam_size=5,
-                best_of=5,
-                vad_filter=True,
-                no_speech_threshold=0.4,
-                log_prob_threshold=-0.5,
-                temperature=0.0,
-            )
-            segments = filter_segments(segments)
-            probability = "forced"
+        with timed("decode"):
+            decode_audio_to_file(file_path, pcm_path)
+        audio, mapping = map_pcm_file(pcm_path)
+        with timed("vad"):
+            speech = detect_speech(audio, mapping)
+        if cached:
+            audio_cache.store_file(content_hash, pcm_path, speech)
+    finally:
+        if os.path.exists(pcm_path):
+            os.remove(pcm_path)
+    return audio, speech, mapping
+
+# Function to pick a few speech windows spread over the recording for language detection
+def get_language_windows(audio, speech, count=language_detection_windows):
+    window_samples = language_window_seconds * sampling_rate
+    if not speech:
+        return [audio[:window_samples]]
+
+    if count <= 1 or len(speech) == 1:
+        starts = [0]
+    else:
+        starts = sorted({round(i * (len(speech) - 1) / (count - 1)) for i in range(count)})
+
+    windows = []
+    for start in starts:
+        # Collect speech from this chunk onwards until the window is full, skipping the silence in between
+        pieces = []
+        collected = 0
+        for chunk in speech[start:]:
+            piece = audio[chunk["start"]:chunk["end"]][:window_samples - collected]
+            pieces.append(piece)
+            collected += len(piece)
+            if collected >= window_samples:
+                break
+        windows.append(np.concatenate(pieces))
+    return windows
+
+# Function to resolve the transcription language before the main pass.
+# Falls back to English when the detection is not confident, like a second forced pass used to.
+def resolve_language(audio, speech, loader):
+    # The .en models only transcribe English and CTranslate2 refuses to detect a language with them
+    if not loader.get().model.is_multilingual:
+        print("The model is English-only, transcribing to english.")
+        return "en", 1.0
+
+    windows = get_language_windows(audio, speech)
+    totals = {}
+    for window in windows:
+        _, _, all_language_probs = loader.get().detect_language(audio=window)
+        for language, probability in all_language_probs:
+            totals[language] = totals.get(language, 0.0) + probability
+
+    language = max(totals, key=totals.get)
+    language_probability = totals[language] / len(windows)
+
+    if language_probability < 0.9 and language != "en":
+        print(f"Detected language '{language}' with probability {language_probability}. The detected language is likely wrong, transcribing to english.")
+        return "en", "forced"
+
+    print(f"Detected language '{language}' with probability {language_probability}")
+    return language, language_probability
+
+# Function to split a long recording into chunks of roughly chunk_samples, cutting in the middle of the
+# silence between two VAD speech segments so that no word is split across a chunk boundary
+def plan_chunks(speech, total_samples, chunk_samples):
+    chunks = []
+    chunk_start = 0
+    for previous, following in zip(speech, speech[1:]):
+        if following["end"] - chunk_start > chunk_samples:
+            cut = (previous["end"] + following["start"]) // 2
+            if cut > chunk_start:
+                chunks.append((chunk_start, cut))
+                chunk_start = cut
+    chunks.append((chunk_start, total_samples))
+    return chunks
+
+# Function to work out how long the chunks planned by iter_segments are, in samples
+def chunk_length(parallel):
+    workers = chunk_workers if parallel else 1
+    chunk_samples = int(chunk_seconds * sampling_rate) if parallel else audio_window_samples
+    if audio_window_samples > 0:
+        # Chunks transcribed in parallel share the ceiling
+        chunk_samples = min(chunk_samples, max(audio_window_samples // workers, sampling_rate))
+    return chunk_samples
+
+# Function to get the batched pipeline wrapped around a loader's model, created on first use
+def get_batched_pipeline(loader):
+    from faster_whisper import BatchedInferencePipeline
+
+    if loader.batched_pipeline is None:
+        loader.batched_pipeline = BatchedInferencePipeline(model=loader.get())
+    return loader.batched_pipeline
+
+# Function to cut (start, end) sample ranges of speech into clips of at most batch_clip_samples.
+# VAD already splits long speech at pauses in batched mode, this only catches speech joined across
+# VAD windows or found with other settings, e.g. in the audio cache.
+def batch_clips(spans):
+    clips = []
+    for span_start, span_end in spans:
+        for clip_start in range(span_start, span_end, batch_clip_samples):
+            clips.append({"start": clip_start, "end": min(clip_start + batch_clip_samples, span_end)})
+    return clips
+
+# Function to run the model on the speech cut out of a recording. spans are the (start, end) sample
+# offsets of the speech pieces in audio. With TRANSCRIBE_BATCH_SIZE they go to the batched pipeline as
+# clip_timestamps, so it batches the speech VAD already found instead of running VAD again.
+def run_model(loader, audio, spans, **options):
+    if batch_size > 0:
+        return get_batched_pipeline(loader).transcribe(audio, batch_size=batch_size, clip_timestamps=batch_clips(spans), **options)
+    return loader.get().transcribe(audio, **options)
+
+# Function to print how fast a transcription ran, to compare the batched and sequential modes
+def report_throughput(file_path, audio_seconds, elapsed):
+    mode = f"batched, batch size {batch_size}" if batch_size > 0 else "sequential"
+    real_time_factor = elapsed / audio_seconds if audio_seconds else 0.0
+    print(f"Transcribed {audio_seconds:.0f}s of {file_path} in {elapsed:.1f}s, real-time factor {real_time_factor:.3f} ({mode})")
+
+# Function to transcribe the speech within one slice of the recording, with timestamps relative to the
+# whole recording. The VAD speech timestamps are already known, so the speech is cut out here and the
+# model runs without its own VAD pass, the same as faster-whisper's vad_filter does internally.
+def transcribe_span(audio, speech, start, end, language, loader):
+    spans = [(max(chunk["start"], start), min(chunk["end"], end)) for chunk in speech if chunk["end"] > start and chunk["start"] < end]
+    if not spans:
+        return
+
+    # Where each speech span starts in the concatenated audio, to map timestamps back
+    span_offsets = []
+    total = 0
+    for span_start, span_end in spans:
+        span_offsets.append(total)
+        total += span_end - span_start
+
+    def restore(seconds, is_end):
+        sample = seconds * sampling_rate
+        # An end that falls exactly on a span boundary belongs to the span before it
+        index = (bisect.bisect_left if is_end else bisect.bisect_right)(span_offsets, sample) - 1
+        index = max(index, 0)
+        return (spans[index][0] + sample - span_offsets[index]) / sampling_rate
+
+    segments, info = run_model(
+        loader,
+        np.concatenate([audio[span_start:span_end] for span_start, span_end in spans]),
+        [(offset, offset + span_end - span_start) for offset, (span_start, span_end) in zip(span_offsets, spans)],
+        task="transcribe",
+        language=language,
+        beam_size=5,
+        best_of=5,
+        vad_filter=False,
+        no_speech_threshold=0.4,
+        log_prob_threshold=-0.5,
+        temperature=0.0,
+    )
+    for segment in filter_segments(segments):
+        yield dataclasses.replace(segment, start=restore(segment.start, False), end=restore(segment.end, True))
+
+# Function to produce the segments of a recording from offset seconds onwards.
+# Recordings longer than chunk_threshold_seconds are split at silences and the chunks are transcribed
+# in parallel; segments are still yielded in order, a chunk at a time. Recordings longer than an audio
+# window are split the same way, so no more than MAX_AUDIO_MEMORY_MB of audio is in memory at once.
+def iter_segments(audio, speech, language, offset, duration_seconds, loader, mapping=None):
+    start = int(offset * sampling_rate)
+    parallel = chunk_threshold_seconds > 0 and duration_seconds >= chunk_threshold_seconds
+    bounded = audio_window_samples > 0 and len(audio) - start > audio_window_samples
+    if not parallel and not bounded:
+        yield from transcribe_span(audio, speech, start, len(audio), language, loader)
+        return
+
+    workers = chunk_workers if parallel else 1
+    chunks = [(max(chunk_start, start), chunk_end) for chunk_start, chunk_end in plan_chunks(speech, len(audio), chunk_length(parallel)) if chunk_end > start]
+    if workers == 1:
+        # One chunk at a time, segments are still passed on as they are produced
+        for chunk_start, chunk_end in chunks:
+            yield from transcribe_span(audio, speech, chunk_start, chunk_end, language, loader)
+            release_audio(mapping, chunk_start, chunk_end)
+        return
+    print(f"Transcribing {len(chunks)} chunks with {workers} workers")
+    executor = ThreadPoolExecutor(max_workers=workers)
+    try:
+        # transcribe_span is a generator, so list() runs the whole chunk inside the worker thread
+        futures = [executor.submit(list, transcribe_span(audio, speech, chunk_start, chunk_end, language, loader)) for chunk_start, chunk_end in chunks]
+        for future, (chunk_start, chunk_end) in zip(futures, chunks):
+            yield from future.result()
+            release_audio(mapping, chunk_start, chunk_end)
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+# Function to build the page header written above the transcription block
+def transcription_header(file_path, language, probability, model_name, draft):
+    file_dir, new_file_name = get_renamed_file_dir_and_name(file_path)
+    return (
+        f"- ![{new_file_name}](../assets/{new_file_name})\n"
+        f"- _metadata_\n"
+        f"  collapsed:: true\n"
+        f"    - Detected language: {language}\n"
+        f"    - Language probability: {probability}\n"
+        f"    - Model: {model_name}\n"
+        f"- #unprocessed\n"
+        + (f"{DRAFT_LINE}\n" if draft else "")
+        + f"-\n"
+        "- "
+    )
+
+# Function to read the checkpoint of an interrupted transcription, if it belongs to this recording
+def read_checkpoint(checkpoint_path, partial_path, source, model_name):
+    try:
+        with open(checkpoint_path) as f:
+            checkpoint = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+    if checkpoint.get("source") != source or checkpoint.get("model") != model_name:
+        return None
+    if not os.path.exists(partial_path) or os.path.getsize(partial_path) < checkpoint["bytes"]:
+        return None
+    return checkpoint
+
+def write_checkpoint(checkpoint_path, checkpoint):
+    tmp_path = checkpoint_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(checkpoint, f)
+    os.replace(tmp_path, checkpoint_path)
+
+# Function to transcribe audio files, returning the language used and the time spent in each stage.
+# on_segment, when given, is called with each segment as soon as it is written.
+def transcribe_audio(file_path, output_file, duration_seconds=None, content_hash=None, on_segment=None):
+    with collect_timings({}) as timings:
+        result = write_transcription(file_path, output_file, duration_seconds, content_hash, on_segment)
+    if result is not None:
+        result["timings"] = timings
+        # A worker process reports its resource use to the main process, which serves the metrics
+        if multiprocessing.parent_process() is not None:
+            result["worker"] = {"pid": os.getpid(), "peak_rss_bytes": peak_rss_bytes(), "model_load_seconds": startup_timings.get("model_load")}
+    return result
+
+# Segments are appended to a hidden .partial file as they are produced, and a checkpoint records the
+# last committed byte offset and timestamp. A restarted run resumes from there, and the finished page
+# is moved into place with a single rename.
+def write_transcription(file_path, output_file, duration_seconds, content_hash, on_segment=None):
+    output_dir, output_name = os.path.split(output_file)
+    partial_path = os.path.join(output_dir, f".{output_name}.partial")
+    checkpoint_path = os.path.join(output_dir, f".{output_name}.checkpoint")
+    try:
+        audio, speech, mapping = load_audio_and_speech(file_path, content_hash)
+        if duration_seconds is None:
+            duration_seconds = len(audio) / sampling_rate
+        source = {"path": file_path, "size": os.path.getsize(file_path)}
+
+        # New recordings go through the draft model first when one is configured
+        loader = first_pass_loader()
+        draft = loader is draft_loader
+        checkpoint = read_checkpoint(checkpoint_path, partial_path, source, loader.model_size)
+        if checkpoint is not None:
+            language, probability = checkpoint["language"], checkpoint["language_probability"]
+            print(f"Resuming {file_path} from {checkpoint['end']:.2f}s")
+            f = open(partial_path, "r+b")
+            f.truncate(checkpoint["bytes"])
+            f.seek(checkpoint["bytes"])
         else:
-            print(f"Detected language '{info.language}' with probability {info.language_probability}")
-            probability = info.language_probability
-
-        file_dir, new_file_name = get_renamed_file_dir_and_name(file_path)
-
-        with open(output_file, 'w') as f:
-            f.write(f"- ![{new_file_name}](../assets/{new_file_name})\n")
-            f.write(f"- _metadata_\n")
-            f.write(f"  collapsed:: true\n")
-            f.write(f"    - Detected language: {info.language}\n")
-            f.write(f"    - Language probability: {probability}\n")
-            f.write(f"    - Model: {model_size}\n")
-            f.write(f"- #unprocessed\n")
-            f.write(f"-\n")
-            f.write("- ")
-            for segment in segments:
+            with timed("language"):
+                language, probability = resolve_language(audio, speech, loader)
+            f = open(partial_path, "wb")
+            f.write(transcription_header(file_path, language, probability, loader.model_size, draft).encode())
+            checkpoint = {
+                "source": source,
+                "model": loader.model_size,
+                "language": language,
+                "language_probability": probability,
+                "bytes": f.tell(),
+                "end": 0.0,
+            }
+            f.flush()
+            write_checkpoint(checkpoint_path, checkpoint)
+
+        with f:
+            transcription_started = time.monotonic()
+            segments = iter_segments(audio, speech, language, checkpoint["end"], duration_seconds, loader, mapping)
+
+            last_checkpoint = time.monotonic()
+            for segment in timed_iter("transcribe", segments):
                 line = f"[{segment.start:.2f}s -> {segment.end:.2f}s] {segment.text}\n"
-                f.write(line)
+                f.write(line.encode())
+                f.flush()
+                if on_segment is not None:
+                    on_segment(segment)
+                if time.monotonic() - last_checkpoint >= checkpoint_interval:
+                    os.fsync(f.fileno())
+                    checkpoint["bytes"] = f.tell()
+                    checkpoint["end"] = segment.end
+                    write_checkpoint(checkpoint_path, checkpoint)
+                    last_checkpoint = time.monotonic()
+            os.fsync(f.fileno())
+
+        report_throughput(file_path, duration_seconds - checkpoint["end"], time.monotonic() - transcription_started)
+
+        os.replace(partial_path, output_file)
+        os.remove(checkpoint_path)
+        return {"language": language, "language_probability": probability, "model": loader.model_size, "draft": draft}
 
     except Exception as e:
         print(f"Error transcribing {file_path}: {e}")
+        return None
 
 
-def retranscribe_audio_to_language(file_path, language):
+# Function to retranscribe a recording to a given language, with the same VAD, chunking and segment
+# filtering as the first pass. Decoded audio and VAD come from the audio cache when the recording was seen before.
+def retranscribe_audio_to_language(file_path, language, content_hash=None):
     try:
-        segments, info = model.transcribe(file_path, beam_size=5, best_of=5, language=language, task="transcribe")
-        # Build the transcription text
-        transcription_lines = []
-        transcription_lines.append("- ")
-        for segment in segments:
-            line = f"[{segment.start:.2f}s -> {segment.end:.2f}s] {segment.text}\n"
-            transcription_lines.append(line)
-        transcription_text = ''.join(transcription_lines)
-        return transcription_text, info
+        audio, speech, mapping = load_audio_and_speech(file_path, content_hash)
+        transcription_text = build_transcription_text(file_path, audio, speech, language, model_loader, mapping)
+        return transcription_text, {"language": language, "language_probability": "forced", "audio_seconds": len(audio) / sampling_rate}
     except Exception as e:
         print(f"Error retranscribing {file_path}: {e}")
         return None, None
-    
+
+# Function to transcribe a whole recording into the text of a transcription block
+def build_transcription_text(file_path, audio, speech, language, loader, mapping=None):
+    duration_seconds = len(audio) / sampling_rate
+    transcription_started = time.monotonic()
+    # Build the transcription text
+    transcription_lines = []
+    transcription_lines.append("- ")
+    for segment in timed_iter("transcribe", iter_segments(audio, speech, language, 0.0, duration_seconds, loader, mapping)):
+        line = f"[{segment.start:.2f}s -> {segment.end:.2f}s] {segment.text}\n"
+        transcription_lines.append(line)
+    report_throughput(file_path, duration_seconds, time.monotonic() - transcription_started)
+    return ''.join(transcription_lines)
+
 def remove_retranscribe_from_str(s):
     s = s.replace(" (retranscribe)", "").replace("(retranscribe)", "").replace(" (retranscribed)", "").replace("(retranscribed)", "")
     return s
 
+# Function to work out the output names for a recording in the /recordings folder.
+# Audio the state index already has a finished transcription of is not transcribed again, but its job
+# is still published so outputs the index has no record of are written and the recording is renamed
+# and backed up. The index stands in for probing the output volumes, they are only checked for audio
+# it has not finished. Returns None for a copy of audio that was published under another recording's name.
+def plan_recording(root, file):
+    file_path = os.path.join(root, file)
+    retranscribe = "retranscribe" in file
+
+    timings = {}
+    with collect_timings(timings), timed("hash"):
+        content_hash = state.hash_file(file_path)
+    record = state.get(content_hash)
+    already_done = record is not None and record["status"] == "done" and not retranscribe
+
+    print(f"Processing file: {file_path}")
+    if retranscribe:
+        print("The file is going to be retranscribed")
+        file = remove_retranscribe_from_str(file)
+
+    file_base_name = os.path.splitext(file)[0]
+    file_date_str, file_time_str = file_base_name.split("_")
+    file_date = datetime.strptime(file_date_str, "%Y-%m-%d")
+
+    # Generate new file name with "r___" prefix and duration suffix
+    with collect_timings(timings), timed("mediainfo"):
+        duration_seconds = get_duration_seconds(file_path)
+    duration = format_duration(duration_seconds)
+
+    year = file_date.year
+    month = f"{file_date.month:02d}"  # Ensure two digits for month
+    day = f"{file_date.day:02d}"
+
+    time_part = file_time_str.replace("-", ".")
+    transcription_file_name = f"r___{year}___{month}___{day}  {time_part}  ({duration}).md"
+    transcription_file_path = os.path.join(transcriptions_dir, transcription_file_name)
+
+    if already_done and record["transcription_path"]:
+        if record["transcription_path"] != transcription_file_path:
+            print(f"Skipping {file_path}, the same audio was already transcribed from {record['source_path']} into {record['transcription_path']}.")
+            return None
+        print(f"{file_path} was already transcribed, publishing any missing copies.")
+        needs_transcription = False
+    else:
+        record = None
+        needs_transcription = retranscribe or not os.path.exists(transcription_file_path)
+
+    # Start loading the model now so it overlaps with probing this and the remaining recordings.
+    # Worker processes load their own, the main process only needs it when transcribing itself.
+    if needs_transcription and transcribe_workers <= 1:
+        first_pass_loader().prefetch()
+
+    return {
+        "file_path": file_path,
+        "content_hash": content_hash,
+        "retranscribe": retranscribe,
+        "year": year,
+        "month": month,
+        "day": day,
+        "time_part": time_part,
+        "duration": duration,
+        "duration_seconds": duration_seconds,
+        "transcription_file_name": transcription_file_name,
+        "transcription_file_path": transcription_file_path,
+        # Check if the file already exists in /transcriptions
+        "needs_transcription": needs_transcription,
+        # The finished state index entry of the audio, or None
+        "record": record,
+        "timings": timings,
+    }
+
+# Function to record in the state index that a recording is being transcribed
+def start_transcription(job):
+    state.update(job["content_hash"], status="transcribing", source_path=job["file_path"], duration=job["duration"])
+
+# Function to copy a finished transcription to Logseq and Obsidian, and rename and back up the recording.
+# Only ever called from the main process, one recording at a time, so the order workers finish in does not matter.
+# result is what transcribe_audio returned, or None when an existing transcription is being published.
+def publish_transcription(job, result=None):
+    file_path = job["file_path"]
+    retranscribe = job["retranscribe"]
+    transcription_file_name = job["transcription_file_name"]
+    transcription_file_path = job["transcription_file_path"]
+
+    # A node that stalled for longer than the lease TTL may have lost the recording to another node
+    if leases is not None and not leases.holds(lease_key(file_path)):
+        print(f"Lost the claim on {file_path} to another node, leaving its outputs to that node.")
+        return
+
+    # The transcription is there when transcribe_audio returned a result, or planning found it
+    if job["needs_transcription"] and result is None:
+        print(f"No transcription was written for {file_path}, leaving the recording in place.")
+        state.update(job["content_hash"], status="failed", source_path=file_path)
+        return
+
+    timings = job["timings"]
+    if result is not None:
+        timings.update(result["timings"])
+    try:
+        with collect_timings(timings), timed("fanout"):
+            logseq_transcription_file_path, obsidian_file_path, record_backup_file_path = fan_out_transcription(job)
+    except FileNotFoundError as e:
+        # The index said the transcription was there, failing the entry has the next scan look again
+        print(f"Could not publish {file_path}: {e}")
+        state.update(job["content_hash"], status="failed", source_path=file_path)
+        return
+
+    fields = {}
+    if result is not None:
+        fields = {
+            "language": result["language"],
+            "language_probability": str(result["language_probability"]),
+            "model": result["model"],
+        }
+    state.update(
+        job["content_hash"],
+        status="done",
+        source_path=file_path,
+        duration=job["duration"],
+        transcription_path=transcription_file_path,
+        logseq_path=logseq_transcription_file_path,
+        obsidian_path=obsidian_file_path,
+        backup_path=record_backup_file_path,
+        **fields,
+    )
+    record_file_timings("transcribe", file_path, timings, job["duration_seconds"])
+    if result is not None and result["draft"]:
+        refiner.submit(transcription_file_name)
+
+# Function to copy the transcription of a recording into Logseq and Obsidian, then rename and back up the audio.
+# Returns the Logseq, Obsidian and backup paths.
+def fan_out_transcription(job):
+    file_path = job["file_path"]
+    retranscribe = job["retranscribe"]
+    transcription_file_name = job["transcription_file_name"]
+    transcription_file_path = job["transcription_file_path"]
+    record = job["record"]
+
+    # Function to tell whether an output still has to be written. For finished audio the index says
+    # where its outputs were written, anything else is looked for on the volume.
+    def needs_output(path, field):
+        if retranscribe:
+            return True
+        if record is not None:
+            return record[field] != path
+        return not os.path.exists(path)
+
+    # Copy the file to /logseq-transcribe
+    logseq_transcription_file_path = os.path.join(logseq_dir, "pages", transcription_file_name)
+    if needs_output(logseq_transcription_file_path, "logseq_path"):
+        materialize(transcription_file_path, logseq_transcription_file_path)
+    else:
+        print(f"Transcription already exists in pages: {logseq_transcription_file_path}")
+
+    # Mirror the transcription into the Obsidian vault using the same naming pattern
+    obsidian_parent_dir = os.path.join(obsidian_dir, "r", str(job["year"]), job["month"])
+    obsidian_file_name = f"{job['day']} {job['time_part']} ({job['duration']}).md"
+    obsidian_file_path = os.path.join(obsidian_parent_dir, obsidian_file_name)
+
+    if needs_output(obsidian_file_path, "obsidian_path"):
+        os.makedirs(obsidian_parent_dir, exist_ok=True)
+        materialize(transcription_file_path, obsidian_file_path)
+    else:
+        print(f"Transcription already exists in Obsidian: {obsidian_file_path}")
+
+    new_recording_file_dir, new_recording_file_name = get_renamed_file_dir_and_name(file_path)
+    new_recording_file_path = os.path.join(new_recording_file_dir, new_recording_file_name)
+
+    # Rename the original file by appending (transcribed). A renamed copy of finished audio holds the same audio.
+    if record is not None or retranscribe or not os.path.exists(new_recording_file_path):
+        rename_file_as_transcribed(file_path, new_recording_file_path)
+        print(f"Renamed original file to {new_recording_file_path}")
+        state.remember_file(new_recording_file_path, job["content_hash"])
+
+    # logseq_asset_file_path = os.path.join(logseq_dir, "assets", new_recording_file_name)
+    # if (not os.path.exists(logseq_asset_file_path)) or retranscribe:
+    #     shutil.copyfile(new_recording_file_path, logseq_asset_file_path)
+    # else:
+    #     print(f"File already exists in assets: {logseq_asset_file_path}")
+
+    record_backup_file_path = os.path.join(recordings_backup_dir, new_recording_file_name)
+    if needs_output(record_backup_file_path, "backup_path"):
+        # The recording is never edited, so the backup may share its inode
+        materialize(new_recording_file_path, record_backup_file_path, allow_hardlink=True)
+        state.remember_file(record_backup_file_path, job["content_hash"])
+    else:
+        print(f"File already exists in backup folder: {record_backup_file_path}")
+
+    return logseq_transcription_file_path, obsidian_file_path, record_backup_file_path
+
+# Function to tell whether a file in /recordings still needs to be transcribed, going by its name
+def is_pending_recording(file):
+    # Ignore hidden files and already transcribed files
+    if file.startswith(".") or "(transcribed)" in file:
+        return False
+    # Process supported audio files
+    return file.endswith((".mp3", ".wav", ".flac", ".m4a"))
+
+# Lease files on a shared volume. A lease is created with link(), which fails when the lease exists
+# and is atomic on NFS too, and a heartbeat thread renews the leases held by bumping their mtime.
+# A lease not renewed within ttl is renamed to a tombstone by whoever finds it, again atomic, and
+# only the node whose rename succeeds takes it over.
+class LeaseManager:
+    def __init__(self, directory, owner, ttl):
+        self.directory = directory
+        self.owner = owner
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        # key -> token of the lease file written for it
+        self.held = {}
+        self.thread = None
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key.encode()).hexdigest() + ".lease")
+
+    def read(self, lease_path):
+        try:
+            with open(lease_path) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    # Returns True when the lease on key was taken, False when another node holds it
+    def acquire(self, key):
+        lease_path = self.path(key)
+        token = f"{self.owner}.{os.getpid()}.{os.urandom(8).hex()}"
+        tmp_path = f"{lease_path}.{token}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"owner": self.owner, "token": token, "key": key, "acquired_at": time.time()}, f)
+        try:
+            for attempt in range(2):
+                try:
+                    os.link(tmp_path, lease_path)
+                except FileExistsError:
+                    if attempt == 0 and self.reclaim(lease_path):
+                        continue
+                    return False
+                except OSError:
+                    # NFS can report a link that went through as failed, the link count tells
+                    if os.stat(tmp_path).st_nlink != 2:
+                        raise
+                with self.lock:
+                    self.held[key] = token
+                    if self.thread is None:
+                        self.thread = threading.Thread(target=self.heartbeat, daemon=True)
+                        self.thread.start()
+                return True
+            return False
+        finally:
+            os.remove(tmp_path)
+
+    # Function to move a lease out of the way if it was not renewed within the ttl.
+    # Returns True when the lease is gone and can be taken.
+    def reclaim(self, lease_path):
+        try:
+            stat = os.stat(lease_path)
+        except FileNotFoundError:
+            return True
+        if time.time() - stat.st_mtime < self.ttl:
+            return False
+        tombstone_path = f"{lease_path}.{self.owner}.{os.getpid()}.stale"
+        try:
+            os.rename(lease_path, tombstone_path)
+        except FileNotFoundError:
+            # Another node moved it first, whoever links a new lease next has it
+            return True
+        # The lease may have been renewed or replaced since the stat, a live one goes back
+        tombstone = os.stat(tombstone_path)
+        if (tombstone.st_ino, tombstone.st_mtime_ns) != (stat.st_ino, stat.st_mtime_ns):
+            try:
+                os.link(tombstone_path, lease_path)
+            except FileExistsError:
+                pass
+            os.remove(tombstone_path)
+            return False
+        lease = self.read(tombstone_path) or {}
+        print(f"Reclaimed the lease on {lease.get('key')} left by {lease.get('owner')}")
+        os.remove(tombstone_path)
+        return True
+
+    # Function to renew a lease, returns False when it is no longer ours
+    def renew(self, key, token):
+        lease_path = self.path(key)
+        lease = self.read(lease_path)
+        if lease is None or lease["token"] != token:
+            return False
+        try:
+            os.utime(lease_path)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def holds(self, key):
+        with self.lock:
+            token = self.held.get(key)
+        return token is not None and self.renew(key, token)
+
+    def release(self, key):
+        with self.lock:
+            token = self.held.pop(key, None)
+        if token is None:
+            return
+        lease_path = self.path(key)
+        tombstone_path = f"{lease_path}.{token}.released"
+        try:
+            os.rename(lease_path, tombstone_path)
+        except FileNotFoundError:
+            return
+        # Only remove the lease if it is still the one this node wrote
+        lease = self.read(tombstone_path)
+        if lease is None or lease["token"] != token:
+            try:
+                os.link(tombstone_path, lease_path)
+            except FileExistsError:
+                pass
+        os.remove(tombstone_path)
+
+    def heartbeat(self):
+        while True:
+            time.sleep(self.ttl / 3)
+            with self.lock:
+                held = list(self.held.items())
+            for key, token in held:
+                if not self.renew(key, token):
+                    print(f"Lost the lease on {key}, another node may be working on it")
+                    with self.lock:
+                        if self.held.get(key) == token:
+                            del self.held[key]
+
+leases = LeaseManager(lease_dir, node_id, lease_ttl) if shared_recordings and multiprocessing.parent_process() is None else None
+
+# Recordings this process is working on. The watcher, directory scans and the HTTP API each claim a
+# recording before touching it and release it once it is published, and with SHARED_RECORDINGS the
+# claim is also a lease that keeps other nodes away.
+claimed_recordings = set()
+claimed_recordings_lock = threading.Lock()
+
+def lease_key(file_path):
+    return os.path.relpath(file_path, recordings_dir)
+
+def claim_recording(file_path):
+    with claimed_recordings_lock:
+        if file_path in claimed_recordings:
+            return False
+        claimed_recordings.add(file_path)
+    if leases is not None and not leases.acquire(lease_key(file_path)):
+        with claimed_recordings_lock:
+            claimed_recordings.discard(file_path)
+        return False
+    return True
+
+def release_recording(file_path):
+    if leases is not None:
+        leases.release(lease_key(file_path))
+    with claimed_recordings_lock:
+        claimed_recordings.discard(file_path)
+
+def is_claimed_recording(file_path):
+    with claimed_recordings_lock:
+        return file_path in claimed_recordings
+
+# Function to claim a planned recording right before working on it. Claiming one recording at a time
+# rather than the whole scan lets several nodes split the backlog between them.
+def claim_job(job):
+    file_path = job["file_path"]
+    if not claim_recording(file_path):
+        print(f"Skipping {file_path}, it is claimed elsewhere.")
+        return False
+    # Another node may have finished and renamed it since it was planned
+    if leases is not None and not os.path.exists(file_path):
+        release_recording(file_path)
+        print(f"Skipping {file_path}, it was transcribed elsewhere.")
+        return False
+    return True
+
+# Function to transcribe and publish a single recording, used by the watch daemon
+def transcribe_recording(file_path):
+    root, file = os.path.split(file_path)
+    if not is_pending_recording(file) or not claim_recording(file_path):
+        return
+    try:
+        # The recording may have been moved away while its job waited, or finished by another node
+        if not os.path.exists(file_path):
+            return
+        job = plan_recording(root, file)
+        if job is None:
+            return
+        result = None
+        if job["needs_transcription"]:
+            start_transcription(job)
+            metrics.set("transcribe_files_in_flight", 1)
+            result = transcribe_audio(job["file_path"], job["transcription_file_path"], job["duration_seconds"], job["content_hash"])
+            metrics.set("transcribe_files_in_flight", 0)
+        else:
+            print(f"Skipping {job['file_path']}, transcription already exists.")
+        publish_transcription(job, result)
+    finally:
+        release_recording(file_path)
+
 # Loop through files in the /recordings folder
 def transcribe_files_in_directory():
     print("Transcribing files in the recordings directory...")
+    scan_started = time.perf_counter()
+    jobs = []
+    planned_transcriptions = set()
     for root, dirs, files in os.walk(recordings_dir):
+        dirs[:] = [directory for directory in dirs if not directory.startswith(".")]
         for file in files:
-            # Ignore hidden files and already transcribed files
-            if file.startswith(".") or "(transcribed)" in file:
-                continue
-            
-            # Process supported audio files
-            if file.endswith((".mp3", ".wav", ".flac", ".m4a")):  
-                file_path = os.path.join(root, file)
-                print(f"Processing file: {file_path}")
-
-                retranscribe = False
-                if "retranscribe" in file:
-                    print("The file is going to be retranscribed")
-                    retranscribe = True
-                    file = remove_retranscribe_from_str(file)
+            if is_pending_recording(file) and not is_claimed_recording(os.path.join(root, file)):
+                job = plan_recording(root, file)
+                if job is None:
+                    continue
 
-                file_base_name = os.path.splitext(file)[0]
-                file_date_str, file_time_str = file_base_name.split("_")
-                file_date = datetime.strptime(file_date_str, "%Y-%m-%d")
+                # Two recordings can map to the same page, e.g. "x.m4a" and "x (retranscribe).m4a"
+                if job["transcription_file_path"] in planned_transcriptions:
+                    print(f"Skipping {job['file_path']}, another recording in this run writes {job['transcription_file_name']}.")
+                    continue
+                planned_transcriptions.add(job["transcription_file_path"])
 
-                # Generate new file name with "r___" prefix and duration suffix
-                duration = get_duration(file_path)
+                if not job["needs_transcription"]:
+                    print(f"Skipping {job['file_path']}, transcription already exists.")
+                jobs.append(job)
 
-                transcription_file_name = f"r___{os.path.splitext(file)[0]}{duration}.md"
+    # Only the first scan is part of startup, not the rescans of watch mode
+    if "recordings_scan" not in startup_timings:
+        record_startup("recordings_scan", time.perf_counter() - scan_started)
 
+    pending = [job for job in jobs if job["needs_transcription"]]
+    if transcribe_workers > 1 and len(pending) > 1:
+        transcribe_jobs_in_pool(jobs)
+        return
 
-                year = file_date.year
-                month = f"{file_date.month:02d}"  # Ensure two digits for month
-                day = f"{file_date.day:02d}"
+    queued = len(pending)
+    for job in jobs:
+        if job["needs_transcription"]:
+            queued -= 1
+        if not claim_job(job):
+            continue
+        try:
+            result = None
+            if job["needs_transcription"]:
+                set_queue_metrics(queued, 1)
+                # Transcribe and save the output to the .md file
+                start_transcription(job)
+                result = transcribe_audio(job["file_path"], job["transcription_file_path"], job["duration_seconds"], job["content_hash"])
+            publish_transcription(job, result)
+        finally:
+            release_recording(job["file_path"])
+    set_queue_metrics(0, 0)
 
-                time_part = file_time_str.replace("-", ".")
-                transcription_file_name = f"r___{year}___{month}___{day}  {time_part}  ({duration}).md"
-                transcription_file_path = os.path.join(transcriptions_dir, transcription_file_name)
+def set_queue_metrics(queued, in_flight):
+    metrics.set("transcribe_queue_depth", queued)
+    metrics.set("transcribe_files_in_flight", in_flight)
 
-                # Check if the file already exists in /transcriptions
-                if os.path.exists(transcription_file_path) and not retranscribe:
-                    print(f"Skipping {file_path}, transcription already exists.")
-                else:
-                    # Transcribe and save the output to the .md file
-                    transcribe_audio(file_path, transcription_file_path)
+# Function to transcribe jobs in a pool of worker processes, each holding its own model
+def transcribe_jobs_in_pool(jobs):
+    workers = min(transcribe_workers, sum(1 for job in jobs if job["needs_transcription"]))
+    print(f"Transcribing with {workers} workers and {cpu_threads or 'default'} threads per worker")
 
-                # Copy the file to /logseq-transcribe
-                logseq_transcription_file_path = os.path.join(logseq_dir, "pages", transcription_file_name)
-                if (not os.path.exists(logseq_transcription_file_path)) or retranscribe:
-                    shutil.copyfile(transcription_file_path, logseq_transcription_file_path)
-                else:
-                    print(f"Transcription already exists in pages: {logseq_transcription_file_path}")
+    # spawn instead of fork, CTranslate2 thread pools do not survive a fork
+    context = multiprocessing.get_context("spawn")
+    def start_pool():
+        return ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=init_worker)
 
-                # Mirror the transcription into the Obsidian vault using the same naming pattern
-                obsidian_parent_dir = os.path.join(obsidian_dir, "r", str(year), month)
-                os.makedirs(obsidian_parent_dir, exist_ok=True)
-
-                obsidian_file_name = f"{day} {time_part} ({duration}).md"
-                obsidian_file_path = os.path.join(obsidian_parent_dir, obsidian_file_name)
+    pool = start_pool()
+    try:
+        futures = {}
+        remaining = iter(jobs)
+        queued = sum(1 for job in jobs if job["needs_transcription"])
 
-                if (not os.path.exists(obsidian_file_path)) or retranscribe:
-                    shutil.copyfile(transcription_file_path, obsidian_file_path)
-                else:
-                    print(f"Transcription already exists in Obsidian: {obsidian_file_path}")
-                
-                new_recording_file_dir, new_recording_file_name = get_renamed_file_dir_and_name(file_path)
-                new_recording_file_path = os.path.join(new_recording_file_dir, new_recording_file_name)
+        # Jobs are claimed and handed to the pool only as workers free up, a claimed job waiting in
+        # the pool's queue would keep other nodes from it
+        def submit_next():
+            nonlocal queued, pool
+            for job in remaining:
+                if job["needs_transcription"]:
+                    queued -= 1
+                if not claim_job(job):
+                    continue
+                if job["needs_transcription"]:
+                    start_transcription(job)
+                    # A worker that died (killed for memory, a crash in the model) breaks the whole pool,
+                    # the jobs it was running fail and the rest go to a new one
+                    for attempt in range(2):
+                        try:
+                            future = pool.submit(transcribe_audio, job["file_path"], job["transcription_file_path"], job["duration_seconds"], job["content_hash"])
+                        except BrokenProcessPool as e:
+                            pool.shutdown(wait=False, cancel_futures=True)
+                            if attempt == 1:
+                                print(f"Error transcribing {job['file_path']}: {e}")
+                                break
+                            print("A transcription worker died, starting a new worker pool")
+                            pool = start_pool()
+                            continue
+                        futures[future] = job
+                        return
+                    try:
+                        publish_transcription(job)
+                    finally:
+                        release_recording(job["file_path"])
+                    continue
+                try:
+                    publish_transcription(job)
+                finally:
+                    release_recording(job["file_path"])
 
-                # Rename the original file by appending (transcribed)
-                if (not os.path.exists(new_recording_file_path)) or retranscribe:
-                    rename_file_as_transcribed(file_path, new_recording_file_path)
-                    print(f"Renamed original file to {new_recording_file_path}")
-                
-                # logseq_asset_file_path = os.path.join(logseq_dir, "assets", new_recording_file_name)
-                # if (not os.path.exists(logseq_asset_file_path)) or retranscribe:
-                #     shutil.copyfile(new_recording_file_path, logseq_asset_file_path)
-                # else:
-                #     print(f"File already exists in assets: {logseq_asset_file_path}")
-
-                record_backup_file_path = os.path.join(recordings_backup_dir, new_recording_file_name)
-                if (not os.path.exists(record_backup_file_path)) or retranscribe:
-                    shutil.copyfile(new_recording_file_path, record_backup_file_path)
-                else:
-                    print(f"File already exists in backup folder: {record_backup_file_path}")
+        for _ in range(workers):
+            submit_next()
+        set_queue_metrics(queued, len(futures))
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                job = futures.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    print(f"Error transcribing {job['file_path']}: {e}")
+                    result = None
+                if result is not None:
+                    record_worker_stats(result["worker"], first_pass_loader())
+                try:
+                    publish_transcription(job, result)
+                finally:
+                    release_recording(job["file_path"])
+                submit_next()
+            set_queue_metrics(queued, len(futures))
+    finally:
+        pool.shutdown()
 
 #Function to retranscribe files in the logseq directory based on #retranscribe/(language) tag
 def extract_filename_from_markdown_line(line):
@@ -266,172 +1665,747 @@ def extract_filename_from_markdown_line(line):
         return None  # or raise an error
 
 # Function to retranscribe files in the logseq directory based on #retranscribe/(language) tag
-def retranscribe_files_in_logseq():
+def retranscribe_files_in_logseq(include_unprocessed=reprocess_unprocessed):
     pages_dir = os.path.join(logseq_dir, "pages")
     print(f"Checking for files to retranscribe in {pages_dir}")
-    for file_name in os.listdir(pages_dir):
-        if not file_name.startswith("r___") or not file_name.endswith(".md"):
+    scan_started = time.perf_counter()
+    checked = 0
+    skipped = 0
+    seen = set()
+    for entry in os.scandir(pages_dir):
+        if not entry.name.startswith("r___") or not entry.name.endswith(".md"):
             continue
-        file_path = os.path.join(pages_dir, file_name)
-        with open(file_path, 'r') as f:
-            lines = f.readlines()
-        # Check if file contains '#retranscribe/(language)'
-        retranscribe_line_idx = None
-        retranscribe_language = None
-        unprocessed_line_idx = None
+        checked += 1
+        seen.add(entry.path)
+        # Pages whose size and mtime match the cache are not read again unless they carry a tag to act on
+        stat = entry.stat()
+        cached = state.get_page(entry.path, stat)
+        if cached is not None and not page_needs_retranscription(cached, include_unprocessed):
+            skipped += 1
+            if cached.get("draft_line") is not None:
+                refiner.submit(entry.name)
+            continue
+        retranscribe_logseq_page(entry.path, include_unprocessed)
+    state.prune_pages(seen)
+    print(f"Checked {checked} pages, skipped {skipped} unchanged pages")
+    record_startup("page_scan", time.perf_counter() - scan_started)
 
-        for idx, line in enumerate(lines):
-            if reprocess_unprocessed and '#unprocessed' in line:
-                unprocessed_line_idx = idx
-                retranscribe_language = "en"
-            if '#retranscribe' in line:
-                retranscribe_line = line.strip()
-                retranscribe_line_idx = idx
-
-                if '/' in retranscribe_line and len(retranscribe_line.split('#retranscribe/')[1].strip()) > 0:
-                    retranscribe_language = retranscribe_line.split('#retranscribe/')[1].strip()
-                else:
-                    retranscribe_language = "en"
-                    print(f"No language specified in retranscribe tag, defaulting to English (en)")
+TRANSCRIPTION_BLOCK_START = re.compile(r'- \[.*?\s->\s.*?\]')
+TRANSCRIPTION_BLOCK_LINE = re.compile(r'\[.*?\s->\s.*?\]')
+
+# Function to find the transcription block of a page as a (start, end) line range, or None.
+# The transcription block starts with '- [' and ends when the pattern no longer matches
+def find_transcription_block(lines):
+    for start, line in enumerate(lines):
+        if TRANSCRIPTION_BLOCK_START.match(line.strip()):
+            break
+    else:
+        return None
+    for end in range(start + 1, len(lines)):
+        if not TRANSCRIPTION_BLOCK_LINE.match(lines[end].strip()):
+            return start, end
+    return start, len(lines)
+
+# The line transcription_header writes into the header of a page transcribed by the draft model
+DRAFT_LINE = "- #draft"
+
+# Function to find the draft line of a page, or None. Only the exact header line above the transcription
+# block counts, so #draft tags a user writes in their own notes never send a page to refinement.
+def find_draft_line(lines):
+    transcription_block = find_transcription_block(lines)
+    if transcription_block is None:
+        return None
+    for idx in range(transcription_block[0]):
+        if lines[idx].rstrip() == DRAFT_LINE:
+            return idx
+    return None
 
+# Function to swap the transcription block of a page for new text and update the metadata block to
+# say which language and model produced it. The first line carrying each of tags is removed, and with
+# drop_draft the draft line too. Returns the new lines, or None when the page has no transcription block.
+def replace_transcription(lines, new_transcription, language, probability, model_name, tags, drop_draft=False):
+    lines = list(lines)
+    if drop_draft:
+        draft_line_idx = find_draft_line(lines)
+        if draft_line_idx is not None:
+            del lines[draft_line_idx]
+    for tag in tags:
+        for idx, line in enumerate(lines):
+            if tag in line:
+                del lines[idx]
                 break
+    # Update the metadata block
+    for idx, line in enumerate(lines):
+        if 'Detected language:' in line:
+            lines[idx] = f"    - Detected language: {language}\n"
+        elif 'Language probability:' in line:
+            lines[idx] = f"    - Language probability: {probability}\n"
+        elif '    - Model:' in line:
+            lines[idx] = f"    - Model: {model_name}\n"
+    # Find the start and end of the transcription block
+    transcription_block = find_transcription_block(lines)
+    if transcription_block is None:
+        return None
+    transcription_start_idx, transcription_end_idx = transcription_block
+    return lines[:transcription_start_idx] + [new_transcription] + lines[transcription_end_idx:]
+
+# Function to parse the parts of a page the retranscription cares about: its tags,
+# the audio link and the transcription block. The result is cached per page in the state index.
+def parse_logseq_page(lines):
+    parsed = {
+        "retranscribe_line": None,
+        "retranscribe_language": None,
+        "unprocessed_line": None,
+        "draft_line": None,
+        "audio_line": None,
+        "audio_file": None,
+        "transcription_block": None,
+    }
+    for idx, line in enumerate(lines):
+        if '#unprocessed' in line:
+            parsed["unprocessed_line"] = idx
+        if '#retranscribe' in line:
+            retranscribe_line = line.strip()
+            parsed["retranscribe_line"] = idx
+            if '/' in retranscribe_line and len(retranscribe_line.split('#retranscribe/')[1].strip()) > 0:
+                parsed["retranscribe_language"] = retranscribe_line.split('#retranscribe/')[1].strip()
+            break
+    for idx, line in enumerate(lines):
+        if '- ![' in line:
+            parsed["audio_line"] = idx
+            parsed["audio_file"] = extract_filename_from_markdown_line(line.strip())
+            break
+    parsed["transcription_block"] = find_transcription_block(lines)
+    parsed["draft_line"] = find_draft_line(lines)
+    return parsed
+
+def page_needs_retranscription(parsed, include_unprocessed):
+    return parsed["retranscribe_line"] is not None or (include_unprocessed and parsed["unprocessed_line"] is not None)
+
+# Function to retranscribe a single Logseq page if it carries a #retranscribe/(language) tag.
+# With include_unprocessed, pages tagged #unprocessed are retranscribed to English as well.
+def retranscribe_logseq_page(file_path, include_unprocessed=reprocess_unprocessed):
+    file_name = os.path.basename(file_path)
+    stat = os.stat(file_path)
+    with open(file_path, 'r') as f:
+        lines = f.readlines()
+    parsed = parse_logseq_page(lines)
+    state.set_page(file_path, stat, parsed)
+
+    # Check if file contains '#retranscribe/(language)'
+    if not page_needs_retranscription(parsed, include_unprocessed):
+        # Drafts left over from an earlier run are refined in the background
+        if parsed["draft_line"] is not None:
+            refiner.submit(file_name)
+        return
+    model_loader.prefetch()
 
-        if retranscribe_language is not None and (retranscribe_line_idx is not None or unprocessed_line_idx is not None):
-            language = retranscribe_language
-            print(f"Retranscribing {file_name} to language '{language}'")
-            # Remove the #retranscribe/ line
-
-            if retranscribe_line_idx is not None:
-                del lines[retranscribe_line_idx]
-            # Update the metadata block
-            for idx, line in enumerate(lines):
-                if 'Detected language:' in line:
-                    lines[idx] = f"    - Detected language: {language}\n"
-                elif 'Language probability:' in line:
-                    lines[idx] = f"    - Language probability: forced\n"
-            # Find the audio file
-            audio_file_line = None
-            for idx, line in enumerate(lines):
-                if '- ![' in line:
-                    audio_file_line = line.strip()
-                    break
-            if audio_file_line:
-                # Extract audio file name using the new function
-                audio_file_name_in_path = extract_filename_from_markdown_line(audio_file_line)
-                if audio_file_name_in_path:
-                    # The audio file should be in recordings_backup_dir
-                    audio_file_path = os.path.join(recordings_backup_dir, audio_file_name_in_path)
+    retranscribe_line_idx = parsed["retranscribe_line"]
+    if retranscribe_line_idx is None:
+        language = "en"
+    elif parsed["retranscribe_language"] is not None:
+        language = parsed["retranscribe_language"]
+    else:
+        language = "en"
+        print(f"No language specified in retranscribe tag, defaulting to English (en)")
+
+    print(f"Retranscribing {file_name} to language '{language}'")
+    # Find the audio file
+    if parsed["audio_line"] is not None:
+        audio_file_name_in_path = parsed["audio_file"]
+        if audio_file_name_in_path:
+            # The audio file should be in recordings_backup_dir
+            audio_file_path = os.path.join(recordings_backup_dir, audio_file_name_in_path)
+            if not os.path.exists(audio_file_path):
+                print(f"Audio file {audio_file_path} not found in recordings backup directory. Trying the recordings directory.")
+                
+                audio_file_path = os.path.join(recordings_dir, audio_file_name_in_path)
+                if not os.path.exists(audio_file_path):
+                    print(f"Audio file {audio_file_path} not found in recordings directory. Trying the logseq assets directory.")
+                    audio_file_path = os.path.join(logseq_dir, "assets", audio_file_name_in_path)
                     if not os.path.exists(audio_file_path):
-                        print(f"Audio file {audio_file_path} not found in recordings backup directory. Trying the recordings directory.")
-                        
-                        audio_file_path = os.path.join(recordings_dir, audio_file_name_in_path)
-                        if not os.path.exists(audio_file_path):
-                            print(f"Audio file {audio_file_path} not found in recordings directory. Trying the logseq assets directory.")
-                            audio_file_path = os.path.join(logseq_dir, "assets", audio_file_name_in_path)
-                            if not os.path.exists(audio_file_path):
-                                print(f"Audio file {audio_file_path} not found in logseq assets directory. Skipping {file_name}")
-                                continue
-                            else:
-                                shutil.copyfile(audio_file_path, os.path.join(recordings_backup_dir, audio_file_name_in_path))
-                                print(f"Copied {audio_file_path} to {os.path.join(recordings_backup_dir, audio_file_name_in_path)}")
-                        else:
-                            shutil.copyfile(audio_file_path, os.path.join(recordings_backup_dir, audio_file_name_in_path))
-                            print(f"Copied {audio_file_path} to {os.path.join(recordings_backup_dir, audio_file_name_in_path)}")
-
-                    # Retranscribe the audio file to the specified language
-                    new_transcription, info = retranscribe_audio_to_language(audio_file_path, language)
-                    if new_transcription is None:
-                        print(f"Failed to retranscribe {audio_file_name_in_path}")
-                        continue
-                    # Find the start and end of the transcription block
-                    # The transcription block starts with '- [' and ends when the pattern no longer matches
-                    transcription_start_idx = None
-                    for idx, line in enumerate(lines):
-                        if re.match(r'- \[.*?\s->\s.*?\]', line.strip()):
-                            transcription_start_idx = idx
-                            break
-                    if transcription_start_idx is None:
-                        print(f"Could not find transcription block in {file_name}")
-                        continue
-                    # Find the end of the transcription block
-                    transcription_end_idx = transcription_start_idx + 1
-                    for idx in range(transcription_start_idx + 1, len(lines)):
-                        if not re.match(r'\[.*?\s->\s.*?\]', lines[idx].strip()):
-                            transcription_end_idx = idx
-                            break
+                        print(f"Audio file {audio_file_path} not found in logseq assets directory. Skipping {file_name}")
+                        return
                     else:
-                        transcription_end_idx = len(lines)
-                    # Build the new content
-                    new_lines = lines[:transcription_start_idx]
-                    # Add the new transcription
-                    new_lines.append(new_transcription)
-                    # Add the remaining lines
-                    new_lines.extend(lines[transcription_end_idx:])
-                    # Write the updated content back to the file
-                    with open(file_path, 'w') as f:
-                        f.writelines(new_lines)
-                    print(f"Updated transcription in {file_path}")
-                    # Also update the corresponding file in the transcriptions directory
-                    transcription_file_path = os.path.join(transcriptions_dir, file_name)
-                    if os.path.exists(transcription_file_path):
-                        # The code to update the transcription file is similar
-                        with open(transcription_file_path, 'r') as f:
-                            transcription_lines = f.readlines()
-                        # Remove the #retranscribe/ line if it exists
-                        retranscribe_line_idx_transcription = None
-                        for idx, line in enumerate(transcription_lines):
-                            if '#retranscribe/' in line:
-                                retranscribe_line_idx_transcription = idx
-                                break
-                        if retranscribe_line_idx_transcription is not None:
-                            del transcription_lines[retranscribe_line_idx_transcription]
-                        # Update the metadata block
-                        for idx, line in enumerate(transcription_lines):
-                            if 'Detected language:' in line:
-                                transcription_lines[idx] = f"    - Detected language: {language}\n"
-                            elif 'Language probability:' in line:
-                                transcription_lines[idx] = f"    - Language probability: forced\n"
-                        # Find the transcription block
-                        transcription_start_idx_transcription = None
-                        for idx, line in enumerate(transcription_lines):
-                            if re.match(r'- \[.*?\s->\s.*?\]', line.strip()):
-                                transcription_start_idx_transcription = idx
-                                break
-                        if transcription_start_idx_transcription is not None:
-                            # Find the end of the transcription block
-                            transcription_end_idx_transcription = transcription_start_idx_transcription + 1
-                            for idx in range(transcription_start_idx_transcription + 1, len(transcription_lines)):
-                                if not re.match(r'\[.*?\s->\s.*?\]', transcription_lines[idx].strip()):
-                                    transcription_end_idx_transcription = idx
-                                    break
-                            else:
-                                transcription_end_idx_transcription = len(transcription_lines)
-                            # Build the new content
-                            new_transcription_lines = transcription_lines[:transcription_start_idx_transcription]
-                            new_transcription_lines.append(new_transcription)
-                            new_transcription_lines.extend(transcription_lines[transcription_end_idx_transcription:])
-                            # Write the updated content back to the transcription file
-                            with open(transcription_file_path, 'w') as f:
-                                f.writelines(new_transcription_lines)
-                            print(f"Updated transcription in {transcription_file_path}")
-                        else:
-                            print(f"Could not find transcription block in {transcription_file_path}")
-                    else:
-                        print(f"Corresponding transcription file {transcription_file_path} not found. Copying from pages directory.")
-                        # Copy the pages file to the transcriptions directory
-                        shutil.copyfile(file_path, transcription_file_path)
-                        print(f"Copied {file_path} to {transcription_file_path}")
+                        materialize(audio_file_path, os.path.join(recordings_backup_dir, audio_file_name_in_path), allow_hardlink=True)
+                        print(f"Copied {audio_file_path} to {os.path.join(recordings_backup_dir, audio_file_name_in_path)}")
                 else:
-                    print(f"Could not parse audio file line in {file_name}")
+                    materialize(audio_file_path, os.path.join(recordings_backup_dir, audio_file_name_in_path), allow_hardlink=True)
+                    print(f"Copied {audio_file_path} to {os.path.join(recordings_backup_dir, audio_file_name_in_path)}")
+
+            # Retranscribe the audio file to the specified language
+            timings = {}
+            with collect_timings(timings):
+                with timed("hash"):
+                    content_hash = state.hash_file(audio_file_path)
+                new_transcription, result = retranscribe_audio_to_language(audio_file_path, language, content_hash)
+            if new_transcription is None:
+                print(f"Failed to retranscribe {audio_file_name_in_path}")
+                return
+            record_file_timings("retranscribe", audio_file_path, timings, result["audio_seconds"])
+            # The new text comes from the full model, so a pending draft line goes away with the #retranscribe/ line
+            new_lines = replace_transcription(lines, new_transcription, language, "forced", model_size, ("#retranscribe",), drop_draft=True)
+            if new_lines is None:
+                print(f"Could not find transcription block in {file_name}")
+                return
+            # Write the updated content back to the file
+            write_file_atomic(file_path, ''.join(new_lines))
+            print(f"Updated transcription in {file_path}")
+            # Also update the corresponding file in the transcriptions directory
+            transcription_file_path = os.path.join(transcriptions_dir, file_name)
+            if os.path.exists(transcription_file_path):
+                # The code to update the transcription file is similar
+                with open(transcription_file_path, 'r') as f:
+                    transcription_lines = f.readlines()
+                new_transcription_lines = replace_transcription(transcription_lines, new_transcription, language, "forced", model_size, ("#retranscribe/",), drop_draft=True)
+                if new_transcription_lines is not None:
+                    # Write the updated content back to the transcription file
+                    write_file_atomic(transcription_file_path, ''.join(new_transcription_lines))
+                    print(f"Updated transcription in {transcription_file_path}")
+                else:
+                    print(f"Could not find transcription block in {transcription_file_path}")
             else:
-                print(f"Audio file line not found in {file_name}")
+                print(f"Corresponding transcription file {transcription_file_path} not found. Copying from pages directory.")
+                # Copy the pages file to the transcriptions directory
+                materialize(file_path, transcription_file_path)
+                print(f"Copied {file_path} to {transcription_file_path}")
         else:
-            # No retranscribe tag found
+            print(f"Could not parse audio file line in {file_name}")
+    else:
+        print(f"Audio file line not found in {file_name}")
+
+# Draft refinement: pages written from the draft model carry a #draft tag until WHISPER_MODEL has
+# transcribed the recording again. Refinements run one at a time in a background thread with a raised
+# nice value, so new drafts keep coming out quickly.
+class Refiner:
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.pending = set()
+        self.thread = None
+
+    def submit(self, page_name):
+        with self.lock:
+            if page_name in self.pending:
+                return
+            self.pending.add(page_name)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+        self.queue.put(page_name)
+
+    def run(self):
+        try:
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), refine_niceness)
+        except OSError as e:
+            print(f"Could not lower the priority of the refinement thread: {e}")
+        # Threads inherit the nice value when they are created. refine_page loads refine_loader from this
+        # thread when it first needs it, so the inference threads of its model run niced too.
+        while True:
+            page_name = self.queue.get()
+            try:
+                refine_page(page_name)
+            except Exception as e:
+                print(f"Error refining {page_name}: {e}")
+            finally:
+                with self.lock:
+                    self.pending.discard(page_name)
+                self.queue.task_done()
+
+    def wait(self):
+        if self.thread is not None and self.pending:
+            print(f"Waiting for {len(self.pending)} draft transcriptions to be refined...")
+        self.queue.join()
+
+refiner = Refiner()
+
+# Work for the resident model in watch mode: API submissions, settled recordings and pages, and rescans
+# wait in one queue and a single thread runs them in the order they came, so only one job drives the
+# model at a time. Refinement has its own model and thread. A recording or page is queued once, the
+# events for it that come in while it waits are dropped.
+class ModelJobs:
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.waiting = set()
+        # Jobs queued or running
+        self.pending = 0
+        self.thread = None
+
+    # Queues work() under key. Returns how many jobs are ahead of it, or None when key is already waiting.
+    def submit(self, key, work):
+        with self.lock:
+            if key in self.waiting:
+                return None
+            self.waiting.add(key)
+            ahead = self.pending
+            self.pending += 1
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+        self.queue.put((key, work))
+        metrics.set("model_jobs_queued", ahead + 1)
+        return ahead
+
+    def run(self):
+        while True:
+            key, work = self.queue.get()
+            with self.lock:
+                self.waiting.discard(key)
+            try:
+                work()
+            except Exception as e:
+                print(f"Error handling {key}: {e}")
+            finally:
+                with self.lock:
+                    self.pending -= 1
+                    metrics.set("model_jobs_queued", self.pending)
+                self.queue.task_done()
+
+model_jobs = ModelJobs()
+
+# Function to find a recording referenced by a page, without copying it anywhere
+def locate_audio_file(audio_file_name):
+    for directory in (recordings_backup_dir, recordings_dir, os.path.join(logseq_dir, "assets")):
+        audio_file_path = os.path.join(directory, audio_file_name)
+        if os.path.exists(audio_file_path):
+            return audio_file_path
+    return None
+
+# Function to replace the draft transcription of a page with one from WHISPER_MODEL, in the Logseq page,
+# the transcriptions directory and the Obsidian vault
+def refine_page(page_name):
+    page_path = os.path.join(logseq_dir, "pages", page_name)
+    with open(page_path, 'r') as f:
+        parsed = parse_logseq_page(f.readlines())
+    if parsed["draft_line"] is None:
+        print(f"{page_name} is no longer a draft, nothing to refine")
+        return
+    audio_file_path = locate_audio_file(parsed["audio_file"]) if parsed["audio_file"] else None
+    if audio_file_path is None:
+        print(f"Audio file for {page_name} not found, cannot refine the draft")
+        return
+
+    print(f"Refining draft {page_name} with {model_size}")
+    timings = {}
+    with collect_timings(timings):
+        with timed("hash"):
+            content_hash = state.hash_file(audio_file_path)
+        audio, speech, mapping = load_audio_and_speech(audio_file_path, content_hash)
+        with timed("language"):
+            language, probability = resolve_language(audio, speech, refine_loader)
+        new_transcription = build_transcription_text(audio_file_path, audio, speech, language, refine_loader, mapping)
+    record_file_timings("refine", audio_file_path, timings, len(audio) / sampling_rate)
+
+    record = state.get(content_hash)
+    targets = [page_path, os.path.join(transcriptions_dir, page_name)]
+    if record is not None and record["obsidian_path"]:
+        targets.append(record["obsidian_path"])
+    for path in targets:
+        if not os.path.exists(path):
+            continue
+        # Read again, the page may have been edited while the refinement ran
+        with open(path, 'r') as f:
+            lines = f.readlines()
+        if find_draft_line(lines) is None:
+            print(f"{path} is no longer a draft, leaving it alone")
+            continue
+        new_lines = replace_transcription(lines, new_transcription, language, probability, model_size, (), drop_draft=True)
+        if new_lines is None:
+            print(f"Could not find transcription block in {path}")
             continue
+        write_file_atomic(path, ''.join(new_lines))
+        print(f"Replaced draft transcription in {path}")
+    state.update(content_hash, language=language, language_probability=str(probability), model=model_size)
 
-if __name__ == "__main__":
+# Watch mode: keep the model loaded and react to new recordings and retagged Logseq pages.
+# inotify is used when the kernel provides it; it does not see changes made by other hosts on a
+# network share, so set WATCH_MODE=poll for NAS volumes written from elsewhere.
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+INOTIFY_EVENT = struct.Struct("iIII")
+
+class InotifyWatcher:
+    def __init__(self, directories):
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.libc = libc
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.watches = {}
+        for directory, recursive in directories:
+            self.add_watch(directory, recursive)
+
+    def add_watch(self, directory, recursive):
+        mask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_MODIFY
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f"inotify_add_watch failed for {directory}")
+        self.watches[wd] = (directory, recursive)
+        if recursive:
+            for entry in os.scandir(directory):
+                # Hidden directories such as .leases change all the time and hold no recordings
+                if entry.is_dir(follow_symlinks=False) and not entry.name.startswith("."):
+                    self.add_watch(entry.path, recursive)
+
+    # Returns the changed paths, or None when the kernel queue overflowed and a full rescan is needed
+    def poll(self, timeout):
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return set()
+        changed = set()
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return changed
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+            name = data[offset + INOTIFY_EVENT.size:offset + INOTIFY_EVENT.size + length].rstrip(b"\0")
+            offset += INOTIFY_EVENT.size + length
+            if mask & IN_Q_OVERFLOW:
+                return None
+            if wd not in self.watches or not name:
+                continue
+            directory, recursive = self.watches[wd]
+            path = os.path.join(directory, os.fsdecode(name))
+            if mask & IN_ISDIR:
+                if recursive and mask & (IN_CREATE | IN_MOVED_TO) and not os.fsdecode(name).startswith("."):
+                    self.add_watch(path, recursive)
+                    for sub_root, _, files in os.walk(path):
+                        changed.update(os.path.join(sub_root, file) for file in files)
+                continue
+            changed.add(path)
+        return changed
+
+class PollingWatcher:
+    def __init__(self, directories, interval):
+        self.directories = directories
+        self.interval = interval
+        self.next_scan = 0
+        self.snapshot = self.scan()
+
+    def scan(self):
+        snapshot = {}
+        for directory, recursive in self.directories:
+            stack = [directory]
+            while stack:
+                try:
+                    entries = list(os.scandir(stack.pop()))
+                except FileNotFoundError:
+                    continue
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        if recursive and not entry.name.startswith("."):
+                            stack.append(entry.path)
+                        continue
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    snapshot[entry.path] = (stat.st_size, stat.st_mtime_ns)
+        return snapshot
+
+    def poll(self, timeout):
+        now = time.monotonic()
+        if now < self.next_scan:
+            time.sleep(min(timeout, self.next_scan - now))
+            return set()
+        self.next_scan = now + self.interval
+        snapshot = self.scan()
+        changed = {path for path, signature in snapshot.items() if self.snapshot.get(path) != signature}
+        self.snapshot = snapshot
+        return changed
+
+def create_watcher(directories):
+    if watch_mode != "poll":
+        try:
+            watcher = InotifyWatcher(directories)
+            print("Watching for changes with inotify")
+            return watcher
+        except (OSError, AttributeError) as e:
+            if watch_mode == "inotify":
+                raise
+            print(f"inotify is not available ({e}), falling back to polling")
+    print(f"Watching for changes by polling every {watch_poll_interval}s")
+    return PollingWatcher(directories, watch_poll_interval)
+
+# Function to queue the work for a file that has stopped changing
+def handle_settled_file(path, pages_dir):
+    directory, file_name = os.path.split(path)
+    if directory == pages_dir:
+        if file_name.startswith("r___") and file_name.endswith(".md"):
+            # Only explicit #retranscribe tags trigger on change, #unprocessed pages are left to the startup scan
+            model_jobs.submit(path, lambda: retranscribe_logseq_page(path, include_unprocessed=False))
+    elif is_pending_recording(file_name):
+        model_jobs.submit(path, lambda: transcribe_recording(path))
+
+# Function to look at every page and recording again, queued like any other job
+def rescan_all():
     retranscribe_files_in_logseq()
-    print("Starting transcription for new recordings...")
     transcribe_files_in_directory()
-    print("Transcription complete.")
-    print("Done.")
+
+def run_daemon():
+    pages_dir = os.path.join(logseq_dir, "pages")
+    directories = [(recordings_dir, True), (pages_dir, False)]
+    watcher = create_watcher(directories)
+
+    # Catch up with everything that arrived while the daemon was not running
+    def catch_up():
+        rescan_all()
+        report_startup_timings()
+        print("Waiting for new recordings...")
+    model_jobs.submit("rescan", catch_up)
+
+    # path -> (size, mtime) when last seen, and when that last changed
+    pending = {}
+    next_rescan = time.monotonic() + rescan_interval
+    while True:
+        changed = watcher.poll(watch_tick_seconds)
+        if changed is None:
+            print("Watch queue overflowed, rescanning")
+            model_jobs.submit("rescan", rescan_all)
+            continue
+
+        now = time.monotonic()
+        if rescan_interval > 0 and now >= next_rescan:
+            model_jobs.submit("rescan", transcribe_files_in_directory)
+            next_rescan = now + rescan_interval
+        for path in changed:
+            pending[path] = (None, now)
+        metrics.set("watch_settling_files", len(pending))
+
+        # Debounce: a file is handled once its size and mtime have not changed for the settle time,
+        # so recordings that are still being written or synced are not picked up half way
+        for path, (signature, changed_at) in list(pending.items()):
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                del pending[path]
+                continue
+            current = (stat.st_size, stat.st_mtime_ns)
+            if current != signature:
+                pending[path] = (current, now)
+            elif now - changed_at >= watch_settle_seconds:
+                del pending[path]
+                try:
+                    handle_settled_file(path, pages_dir)
+                except Exception as e:
+                    print(f"Error handling {path}: {e}")
+
+# HTTP server: GET /metrics for Prometheus, and in watch mode POST /transcribe to submit a recording.
+# The request body is either the audio itself, stored in /recordings as ?name= (or the current time),
+# or empty with ?path= naming a recording already in /recordings. Jobs wait in the model job queue with
+# the recordings the watcher found, and go through the same steps as the recordings directory, so they
+# end up in Logseq and Obsidian the same way. A request is answered 429 when API_QUEUE_SIZE jobs of any
+# kind are waiting. The response is a server-sent event stream: queued, started, one segment event per
+# transcribed segment, then done with the output paths, or error.
+api_slots = threading.BoundedSemaphore(api_queue_size)
+upload_content_types = {
+    "audio/mpeg": ".mp3",
+    "audio/wav": ".wav",
+    "audio/x-wav": ".wav",
+    "audio/flac": ".flac",
+    "audio/mp4": ".m4a",
+    "audio/x-m4a": ".m4a",
+}
+RECORDING_NAME = re.compile(r'\d{4}-\d{2}-\d{2}_[^_/]+\.(mp3|wav|flac|m4a)')
+
+# Function to run an accepted API job from the model job queue
+def run_api_job_and_release(file_path, emit):
+    try:
+        run_api_job(file_path, emit)
+    except Exception as e:
+        print(f"Error transcribing {file_path} for the API: {e}")
+        emit("error", {"message": str(e)})
+    finally:
+        release_recording(file_path)
+        api_slots.release()
+
+def run_api_job(file_path, emit):
+    root, file = os.path.split(file_path)
+    job = plan_recording(root, file)
+    if job is None:
+        record = state.get(state.hash_file(file_path))
+        emit("done", api_job_outputs(record))
+        return
+    emit("started", {"file": job["file_path"], "transcription": job["transcription_file_name"], "duration_seconds": job["duration_seconds"]})
+
+    result = None
+    if job["needs_transcription"]:
+        def on_segment(segment):
+            emit("segment", {"start": round(segment.start, 2), "end": round(segment.end, 2), "text": segment.text})
+        start_transcription(job)
+        result = transcribe_audio(job["file_path"], job["transcription_file_path"], job["duration_seconds"], job["content_hash"], on_segment)
+    publish_transcription(job, result)
+
+    record = state.get(job["content_hash"])
+    if record["status"] != "done":
+        emit("error", {"message": f"Transcribing {file} failed"})
+        return
+    emit("done", api_job_outputs(record))
+
+def api_job_outputs(record):
+    fields = ("language", "language_probability", "model", "transcription_path", "logseq_path", "obsidian_path", "backup_path")
+    return {field: record[field] for field in fields}
+
+async def send_response(writer, status, body, content_type="text/plain", headers=()):
+    body = body.encode()
+    head = [f"HTTP/1.1 {status} {http.HTTPStatus(status).phrase}", f"Content-Type: {content_type}", f"Content-Length: {len(body)}", "Connection: close"]
+    head += [f"{name}: {value}" for name, value in headers]
+    writer.write(("\r\n".join(head) + "\r\n\r\n").encode() + body)
+    await writer.drain()
+
+async def handle_http(reader, writer):
+    try:
+        method, target, _ = (await reader.readline()).decode("latin-1").split(" ", 2)
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        url = urllib.parse.urlsplit(target)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        if method == "GET" and url.path == "/metrics":
+            await send_response(writer, 200, metrics.render(), "text/plain; version=0.0.4")
+        elif method == "POST" and url.path == "/transcribe":
+            await handle_transcribe(reader, writer, headers, query)
+        else:
+            await send_response(writer, 404, "Not found\n")
+    except ValueError:
+        await send_response(writer, 400, "Malformed request\n")
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+async def handle_transcribe(reader, writer, headers, query):
+    if not run_as_daemon:
+        await send_response(writer, 503, "Submitting recordings needs TRANSCRIBE_DAEMON=true\n")
+        return
+    if "transfer-encoding" in headers:
+        await send_response(writer, 411, "Send uploads with a Content-Length\n")
+        return
+    length = int(headers.get("content-length", "0"))
+    if length > api_max_upload_bytes:
+        await send_response(writer, 413, f"Uploads are limited to {api_max_upload_bytes} bytes\n")
+        return
+    # Reject before reading the body, so a full queue does not cost a whole upload
+    if model_jobs.pending >= api_queue_size or not api_slots.acquire(blocking=False):
+        metrics.inc("api_jobs_rejected_total")
+        await send_response(writer, 429, "Too many queued recordings\n", headers=[("Retry-After", api_retry_after)])
+        return
+    try:
+        file_path = await receive_recording(reader, writer, headers, query, length)
+    except BaseException:
+        api_slots.release()
+        raise
+    if file_path is None:
+        api_slots.release()
+        return
+
+    loop = asyncio.get_running_loop()
+    events = asyncio.Queue()
+    def emit(event, data):
+        loop.call_soon_threadsafe(events.put_nowait, (event, data))
+    ahead = model_jobs.submit(("api", file_path), lambda: run_api_job_and_release(file_path, emit))
+    print(f"Accepted {file_path} from the API")
+
+    head = ["HTTP/1.1 200 OK", "Content-Type: text/event-stream", "Cache-Control: no-cache", "Connection: close"]
+    writer.write(("\r\n".join(head) + "\r\n\r\n").encode())
+    event, data = "queued", {"file": file_path, "jobs_ahead": ahead}
+    # A client that goes away does not cancel the job, the recording is still transcribed and published
+    while True:
+        writer.write(f"event: {event}\ndata: {json.dumps(data)}\n\n".encode())
+        await writer.drain()
+        if event in ("done", "error"):
+            return
+        event, data = await events.get()
+
+# Function to find or store the recording of an API request and claim it for the API worker.
+# Answers the request and returns None when there is nothing to queue.
+async def receive_recording(reader, writer, headers, query, length):
+    if "path" in query:
+        file_path = os.path.normpath(os.path.join(recordings_dir, query["path"]))
+        if os.path.commonpath([file_path, recordings_dir]) != recordings_dir or not os.path.isfile(file_path):
+            await send_response(writer, 404, f"{query['path']} is not a recording in {recordings_dir}\n")
+            return None
+        if not is_pending_recording(os.path.basename(file_path)):
+            await send_response(writer, 400, f"{query['path']} is not a recording waiting for transcription\n")
+            return None
+        if not claim_recording(file_path):
+            await send_response(writer, 409, f"{query['path']} is already being transcribed\n")
+            return None
+        return file_path
+
+    if length == 0:
+        await send_response(writer, 400, "Send the audio as the request body, or ?path= of a recording\n")
+        return None
+    name = query.get("name")
+    if name is None:
+        extension = upload_content_types.get(headers.get("content-type", "").split(";")[0].strip())
+        if extension is None:
+            await send_response(writer, 400, "Give the recording a ?name= or an audio Content-Type\n")
+            return None
+        name = datetime.now().strftime("%Y-%m-%d_%H-%M-%S") + extension
+    if not RECORDING_NAME.fullmatch(name):
+        await send_response(writer, 400, f"{name} is not a recording name like 2024-01-31_12-00-00.m4a\n")
+        return None
+    file_path = os.path.join(recordings_dir, name)
+    if os.path.exists(file_path) or not claim_recording(file_path):
+        await send_response(writer, 409, f"{name} already exists\n")
+        return None
+
+    # Write to a hidden file first, the recording only appears under its name once it is complete.
+    # The writes go to the default executor, a slow volume would otherwise hold up every other request.
+    upload_path = os.path.join(recordings_dir, f".{name}.upload")
+    loop = asyncio.get_running_loop()
+    try:
+        with open(upload_path, "wb") as f:
+            remaining = length
+            while remaining:
+                chunk = await reader.readexactly(min(remaining, 1024 * 1024))
+                await loop.run_in_executor(None, f.write, chunk)
+                remaining -= len(chunk)
+        await loop.run_in_executor(None, os.replace, upload_path, file_path)
+    except BaseException:
+        release_recording(file_path)
+        if os.path.exists(upload_path):
+            os.remove(upload_path)
+        raise
+    return file_path
+
+async def serve_http():
+    try:
+        server = await asyncio.start_server(handle_http, port=http_port)
+    except OSError as e:
+        print(f"Could not start the HTTP server on port {http_port}: {e}")
+        return
+    print(f"Serving metrics{' and the transcription API' if run_as_daemon else ''} on port {http_port}")
+    async with server:
+        await server.serve_forever()
+
+def start_http_server():
+    if http_port <= 0:
+        return
+    threading.Thread(target=asyncio.run, args=(serve_http(),), daemon=True).start()
+
+if __name__ == "__main__":
+    start_http_server()
+    if run_as_daemon:
+        run_daemon()
+    else:
+        retranscribe_files_in_logseq()
+        print("Starting transcription for new recordings...")
+        transcribe_files_in_directory()
+        refiner.wait()
+        print("Transcription complete.")
+        report_materialized_bytes()
+        report_startup_timings()
+        print("Done.")